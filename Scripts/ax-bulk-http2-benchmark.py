@@ -0,0 +1,208 @@
+### Benchmark for the bulk write transport.  Sends the same concurrent device PUTs through a bulk script's ax_bulk_apply / ax_call_api to a local TLS stub, once over the pooled HTTP/1.1 requests session and once over the -http2 (httpx) client, and compares throughput, client CPU and connections opened.
+### Needs httpx with HTTP/2 support (pip install httpx[http2]) and the openssl command line tool (for the stub's self-signed certificate).
+
+import multiprocessing
+import subprocess
+import argparse
+import tempfile
+import asyncio
+import time
+import ssl
+import sys
+import os
+
+# --Function Block--#
+
+# Exit handler (Error)
+def ax_exit_error(error_code, error_message=None, system_message=None):
+    print(error_code)
+    if error_message is not None:
+        print(error_message)
+    if system_message is not None:
+        print(system_message)
+    sys.exit(1)
+
+# Load a bulk script's function block (everything before its execution block) so the benchmark runs its own ax_call_api and ax_bulk_apply
+def ax_bulk_script_functions(bulk_script):
+    with open(bulk_script, mode='r', encoding='utf-8') as bulk_handle:
+        bulk_source = bulk_handle.read()
+    if '# --Execution Block-- #' not in bulk_source or 'def ax_session_http2' not in bulk_source:
+        ax_exit_error(400, bulk_script + " is not a bulk write script with -http2 support.")
+    bulk_functions = {'__name__': 'ax_bulk_script', '__file__': bulk_script}
+    exec(compile(bulk_source.split('# --Execution Block-- #')[0], bulk_script, 'exec'), bulk_functions)
+    return bulk_functions
+
+# Write a self-signed certificate for localhost with the openssl command line tool
+def ax_stub_certificate_write(certificate_directory):
+    certificate_file = os.path.join(certificate_directory, 'stub.crt')
+    key_file = os.path.join(certificate_directory, 'stub.key')
+    openssl_command = ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                       '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1', '-keyout', key_file, '-out', certificate_file]
+    try:
+        openssl_result = subprocess.run(openssl_command, capture_output=True, text=True)
+    except FileNotFoundError:
+        ax_exit_error(400, "The openssl command line tool is needed to make the stub's certificate.")
+    if openssl_result.returncode != 0:
+        ax_exit_error(500, "openssl could not make the stub's certificate.", openssl_result.stderr)
+    return certificate_file, key_file
+
+# Answer HTTP/1.1 requests on one connection, one at a time, each after the stub latency
+async def ax_stub_http1(stub_reader, stub_writer, stub_latency):
+    while True:
+        request_head = await stub_reader.readuntil(b'\r\n\r\n')
+        content_length = 0
+        for header_line in request_head.split(b'\r\n'):
+            if header_line.lower().startswith(b'content-length:'):
+                content_length = int(header_line.split(b':', 1)[1])
+        if content_length:
+            await stub_reader.readexactly(content_length)
+        await asyncio.sleep(stub_latency)
+        stub_writer.write(b'HTTP/1.1 204 No Content\r\n\r\n')
+        await stub_writer.drain()
+
+# Answer HTTP/2 requests on one connection, every stream after the stub latency (streams are answered side by side)
+async def ax_stub_http2(stub_reader, stub_writer, stub_latency):
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.exceptions
+    stub_connection = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=False))
+    stub_connection.initiate_connection()
+    stub_writer.write(stub_connection.data_to_send())
+    event_loop = asyncio.get_running_loop()
+
+    def ax_stub_http2_respond(stream_id):
+        try:
+            stub_connection.send_headers(stream_id, [(':status', '204')], end_stream=True)
+        except h2.exceptions.H2Error:
+            return
+        stub_writer.write(stub_connection.data_to_send())
+
+    while True:
+        stub_data = await stub_reader.read(65536)
+        if not stub_data:
+            return
+        for stub_event in stub_connection.receive_data(stub_data):
+            if isinstance(stub_event, h2.events.DataReceived):
+                stub_connection.acknowledge_received_data(stub_event.flow_controlled_length, stub_event.stream_id)
+            elif isinstance(stub_event, h2.events.StreamEnded):
+                event_loop.call_later(stub_latency, ax_stub_http2_respond, stub_event.stream_id)
+            elif isinstance(stub_event, h2.events.ConnectionTerminated):
+                return
+        stub_writer.write(stub_connection.data_to_send())
+        await stub_writer.drain()
+
+# Run the stub API (in its own process, so its CPU time isn't counted against the client).  Answers every request with
+# a 204 after stub_latency seconds, over HTTP/2 or HTTP/1.1 as negotiated, and counts the connections for each
+def ax_stub_serve(certificate_file, key_file, stub_latency, connection_counts, port_queue):
+    stub_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    stub_context.load_cert_chain(certificate_file, key_file)
+    stub_context.set_alpn_protocols(['h2', 'http/1.1'])
+
+    async def ax_stub_connection(stub_reader, stub_writer):
+        stub_protocol = stub_writer.get_extra_info('ssl_object').selected_alpn_protocol()
+        with connection_counts.get_lock():
+            connection_counts[0 if stub_protocol == 'h2' else 1] = connection_counts[0 if stub_protocol == 'h2' else 1] + 1
+        try:
+            if stub_protocol == 'h2':
+                await ax_stub_http2(stub_reader, stub_writer, stub_latency)
+            else:
+                await ax_stub_http1(stub_reader, stub_writer, stub_latency)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            stub_writer.close()
+
+    async def ax_stub_main():
+        stub_server = await asyncio.start_server(ax_stub_connection, '127.0.0.1', 0, ssl=stub_context)
+        port_queue.put(stub_server.sockets[0].getsockname()[1])
+        await stub_server.serve_forever()
+
+    asyncio.run(ax_stub_main())
+
+# Send call_count PUTs through the bulk script's ax_bulk_apply over HTTP/1.1 or HTTP/2, returning (wall seconds, CPU seconds)
+def ax_benchmark_run(bulk_script, stub_url, call_count, max_workers, http2):
+    bulk_functions = ax_bulk_script_functions(bulk_script)
+    if http2:
+        bulk_functions['ax_session_http2']()
+    item_list = [{'id': device_number + 1, 'display_name': 'host' + str(device_number).zfill(6)} for device_number in range(call_count)]
+
+    def ax_benchmark_put(item):
+        return bulk_functions['ax_call_api']('PUT', stub_url + '/api/servers/' + str(item['id']), 'benchmark-key', data={'server_group_id': 1}, params={'o': 'benchmark-org'})
+
+    cpu_start = time.process_time()
+    run_start = time.perf_counter()
+    bulk_functions['ax_bulk_apply'](item_list, ax_benchmark_put, max_workers)
+    run_seconds = time.perf_counter() - run_start
+    cpu_seconds = time.process_time() - cpu_start
+    bulk_functions['ax_session'].close()
+    return run_seconds, cpu_seconds
+
+# --Execution Block-- #
+if __name__ == '__main__':
+    # --Parse command line arguments-- #
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '-bulk_script',
+        type=str,
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ax-device-group-update-from-csv.py'),
+        help='(Optional - Default to ax-device-group-update-from-csv.py next to this script)  The bulk write script whose ax_call_api and ax_bulk_apply are benchmarked.')
+
+    parser.add_argument(
+        '-calls',
+        type=int,
+        default=2000,
+        help='(Optional - Default to 2000)  PUT calls to send over each transport.')
+
+    parser.add_argument(
+        '-max_workers',
+        type=int,
+        default=8,
+        help='(Optional - Default to 8)  Most calls to run at once, the same as the bulk scripts\' -max_workers.')
+
+    parser.add_argument(
+        '-latency_ms',
+        type=float,
+        default=20.0,
+        help='(Optional - Default to 20)  Time the stub waits before answering each call, standing in for the API\'s own latency.')
+
+    args = parser.parse_args()
+    # --End parse command line arguments-- #
+
+    # --Main-- #
+
+    try:
+        import httpx
+        import h2
+    except ImportError as import_error:
+        ax_exit_error(400, "The benchmark needs httpx with HTTP/2 support.  Install it with: pip install httpx[http2]", str(import_error))
+    print("httpx " + httpx.__version__ + ", h2 " + h2.__version__)
+
+    with tempfile.TemporaryDirectory() as certificate_directory:
+        certificate_file, key_file = ax_stub_certificate_write(certificate_directory)
+        # Trust the stub's certificate (requests reads REQUESTS_CA_BUNDLE on each call, httpx reads SSL_CERT_FILE when the client is made)
+        os.environ['REQUESTS_CA_BUNDLE'] = certificate_file
+        os.environ['SSL_CERT_FILE'] = certificate_file
+
+        connection_counts = multiprocessing.Array('i', 2)
+        port_queue = multiprocessing.Queue()
+        stub_process = multiprocessing.Process(target=ax_stub_serve, args=(certificate_file, key_file, args.latency_ms / 1000, connection_counts, port_queue), daemon=True)
+        stub_process.start()
+        try:
+            stub_url = 'https://localhost:' + str(port_queue.get(timeout=30))
+            benchmark_results = {}
+            for transport_name, http2 in (('HTTP/1.1 (requests, pooled)', False), ('HTTP/2 (httpx, -http2)', True)):
+                print()
+                print("Sending " + str(args.calls) + " PUTs over " + transport_name + "...")
+                connections_before = list(connection_counts)
+                run_seconds, cpu_seconds = ax_benchmark_run(args.bulk_script, stub_url, args.calls, args.max_workers, http2)
+                benchmark_results[transport_name] = (run_seconds, cpu_seconds, sum(connection_counts) - sum(connections_before))
+        finally:
+            stub_process.terminate()
+            stub_process.join()
+
+    print()
+    print("Transport                       calls/s   client CPU ms/call   connections")
+    for transport_name, (run_seconds, cpu_seconds, connection_count) in benchmark_results.items():
+        print(transport_name.ljust(30) + "{:9.1f}".format(args.calls / max(run_seconds, 0.001)) + "{:21.3f}".format(cpu_seconds * 1000 / args.calls) + "{:14d}".format(connection_count))
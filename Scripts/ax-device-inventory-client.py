@@ -0,0 +1,249 @@
+### Example client that sends query, cleanup and sync jobs to a running ax-device-inventory-service.py
+import argparse
+import atexit
+import socket
+import time
+import json
+import sys
+import csv
+import os
+
+# --Function Block--#
+
+# Exit handler (Error)
+def ax_exit_error(error_code, error_message=None, system_message=None):
+    print(error_code)
+    if error_message is not None:
+        print(error_message)
+    if system_message is not None:
+        print(system_message)
+    sys.exit(1)
+
+# Profiling state, only populated when the run is started with -profile
+ax_profile_state = {'profiler': None, 'profile_file': None, 'phase': None, 'phase_start': None, 'phase_times': {}}
+
+# Start profiling the run and write the report when the script exits (including error exits)
+def ax_profile_start(profile_file):
+    # Imported here so runs without -profile don't pay for loading the profiler
+    import cProfile
+    ax_profile_state['profile_file'] = profile_file
+    ax_profile_state['profiler'] = cProfile.Profile()
+    atexit.register(ax_profile_stop)
+    ax_profile_state['profiler'].enable()
+
+# Mark the start of a run phase (fetch, plan, apply, etc.), closing the previous one
+def ax_profile_phase(phase_name):
+    if ax_profile_state['profiler'] is None:
+        return
+    now = time.perf_counter()
+    if ax_profile_state['phase'] is not None:
+        ax_profile_phase_add(ax_profile_state['phase'], now - ax_profile_state['phase_start'])
+    ax_profile_state['phase'] = phase_name
+    ax_profile_state['phase_start'] = now
+
+# Add time to a phase directly (used for decode time, which is nested inside other phases)
+def ax_profile_phase_add(phase_name, seconds):
+    if ax_profile_state['profiler'] is None:
+        return
+    phase_times = ax_profile_state['phase_times']
+    phase_times[phase_name] = phase_times.get(phase_name, 0.0) + seconds
+
+# Stop profiling, write the profile file and the phase timing summary
+def ax_profile_stop():
+    # Imported here so runs without -profile don't pay for loading pstats
+    import pstats
+    profiler = ax_profile_state['profiler']
+    if profiler is None:
+        return
+    profiler.disable()
+    ax_profile_phase(None)
+    ax_profile_state['profiler'] = None
+    profile_file = ax_profile_state['profile_file']
+    profiler.dump_stats(profile_file)
+
+    summary_lines = ["Phase timing summary (seconds, decode is included in the phase that made the call):"]
+    for phase_name, seconds in ax_profile_state['phase_times'].items():
+        summary_lines.append("  {:<10} {:>10.3f}".format(phase_name, seconds))
+    print()
+    print("\n".join(summary_lines))
+    print("Profile written to " + profile_file + " (phase summary and top functions in " + profile_file + ".txt)")
+    with open(profile_file + ".txt", mode='w') as summary_file:
+        summary_file.write("\n".join(summary_lines) + "\n\n")
+        pstats.Stats(profiler, stream=summary_file).sort_stats('cumulative').print_stats(25)
+
+# Send a job to the inventory service and return its response
+def ax_service_job(port, job):
+    try:
+        with socket.create_connection(('127.0.0.1', port)) as service_socket:
+            service_socket.sendall((json.dumps(job) + "\n").encode('utf-8'))
+            with service_socket.makefile('r', encoding='utf-8') as service_file:
+                response_line = service_file.readline()
+    except OSError as socket_error:
+        ax_exit_error(503, "Could not reach the inventory service on 127.0.0.1:" + str(port) + ".  Is it running?", socket_error)
+    decode_start = time.perf_counter()
+    try:
+        job_response = json.loads(response_line)
+    except ValueError:
+        ax_exit_error(501, 'The service returned an unexpected response.')
+    ax_profile_phase_add('decode', time.perf_counter() - decode_start)
+    return job_response
+
+# Load the CSV file into Dict
+def ax_file_load_csv(file_name,file_encoding='utf-8-sig'):
+    csv_list = []
+    file_name_and_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), file_name)
+    with open(file_name_and_path, mode='r',encoding=file_encoding) as csv_file:
+        file_reader = csv.DictReader(csv_file)
+        for row in file_reader:
+            csv_list.append(row)
+    return csv_list
+
+# Load the CSV file into lists
+def ax_file_load_csv_list(file_name,file_encoding='utf-8-sig'):
+    file_name_and_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), file_name)
+    with open(file_name_and_path, mode='r',encoding=file_encoding) as csv_file:
+        csv_list = list(csv.reader(csv_file, delimiter=","))
+    return csv_list
+
+# --Execution Block-- #
+# --Parse command line arguments-- #
+parser = argparse.ArgumentParser()
+
+parser.add_argument(
+    'job',
+    type=str,
+    choices=['status', 'refresh', 'query', 'cleanup', 'sync'],
+    help='Job to run on the inventory service.')
+
+parser.add_argument(
+    '-port',
+    type=int,
+    default=8765,
+    help='(Optional - Default to 8765)  Local port the inventory service is listening on.')
+
+parser.add_argument(
+    '-token',
+    type=str,
+    help='(Optional) Shared token, if the service was started with one (needed for the cleanup and sync jobs).')
+
+parser.add_argument(
+    '-display_name',
+    type=str,
+    help='(Optional - query) Only list devices with this name (case insensitive).')
+
+parser.add_argument(
+    '-groupId',
+    type=int,
+    help='(Optional - query) Filter based on membership to a specific Server Group ID')
+
+parser.add_argument(
+    '-names_only',
+    action='store_true',
+    help='(Optional-Flag - query) Only print out the device names as a text list')
+
+parser.add_argument(
+    '-mintuesDisconnectFor',
+    type=int,
+    default=10,
+    help='(Optional - cleanup) - Time in minutes the client should be disconnected for, at minimum.')
+
+parser.add_argument(
+    '-remove',
+    action='store_true',
+    help='(Optional-Flag - cleanup) Remove the duplicates found.  Without it the cleanup job only lists them.')
+
+parser.add_argument(
+    '-tag_csv_file',
+    type=str,
+    help='(Optional - sync) File name (and path, if needed) for the CSV file to sync tags for (no header, hostname and owner columns).')
+
+parser.add_argument(
+    '-group_csv_file',
+    type=str,
+    help='(Optional - sync) File name (and path, if needed) for the CSV file to sync groups for ("Server" and "Current Schedule (IST)" columns).')
+
+parser.add_argument(
+    '-csv_column_hostname_position',
+    type=int,
+    default=0,
+    help='(Optional - Default to 0)  Column positon in the tag CSV that contains the hostname to compare.')
+
+parser.add_argument(
+    '-csv_column_owner_position',
+    type=int,
+    default=1,
+    help='(Optional - Default to 1)  Column positon in the tag CSV that contains the owner information.')
+
+parser.add_argument(
+    '-tag_header',
+    type=str,
+    default='Owner-',
+    help='(Optional - Default to "Owner-")  Header for the added tag.')
+
+parser.add_argument(
+    '-fuzzy_match_threshold',
+    type=float,
+    help='(Optional - sync) Fall back to trigram similarity for CSV names with no exact or normalized (case, whitespace, domain) match.  Minimum similarity 0-1, ex. 0.8')
+
+parser.add_argument(
+    '-fuzzy_match_apply',
+    action='store_true',
+    help='(Optional-Flag - sync) Apply fuzzy matches found with -fuzzy_match_threshold.  Without it they are only printed as suggestions.')
+
+parser.add_argument(
+    '-profile',
+    type=str,
+    help='(Optional) Profile the run with cProfile and write the stats to this file (phase timing summary goes to <file>.txt).')
+
+args = parser.parse_args()
+# --End parse command line arguments-- #
+
+# --Main-- #
+
+if args.profile:
+    ax_profile_start(args.profile)
+
+ax_profile_phase('load')
+job = {'job': args.job, 'token': args.token}
+if args.job == 'query':
+    job['display_name'] = args.display_name
+    job['groupId'] = args.groupId
+    job['names_only'] = args.names_only
+elif args.job == 'cleanup':
+    job['mintuesDisconnectFor'] = args.mintuesDisconnectFor
+    job['remove'] = args.remove
+elif args.job == 'sync':
+    if not args.tag_csv_file and not args.group_csv_file:
+        ax_exit_error(400, "Nothing to sync - pass -tag_csv_file and/or -group_csv_file.  Exiting!")
+    job['tag_header'] = args.tag_header
+    job['fuzzy_match_threshold'] = args.fuzzy_match_threshold
+    job['fuzzy_match_apply'] = args.fuzzy_match_apply
+    job['tag_rows'] = []
+    job['group_rows'] = []
+    if args.tag_csv_file:
+        row_count = 0
+        for row in ax_file_load_csv_list(args.tag_csv_file):
+            row_count = row_count + 1
+            if len(row) == 2:
+                job['tag_rows'].append([row[args.csv_column_hostname_position], row[args.csv_column_owner_position]])
+            elif len(row) != 0:
+                print("Found a row without exactly 2 data objects - skipping row #" + str(row_count) + ": " + str(row))
+    if args.group_csv_file:
+        job['group_rows'] = ax_file_load_csv(args.group_csv_file)
+
+ax_profile_phase('apply')
+job_response = ax_service_job(args.port, job)
+
+ax_profile_phase('output')
+for message in job_response['messages']:
+    print(message)
+if job_response['status'] != 'ok':
+    ax_exit_error(500, "The inventory service could not run the " + args.job + " job.")
+
+if args.job == 'query' and args.names_only:
+    for device_name in job_response['data']:
+        print(device_name)
+    print()
+    print("Total devices listed: " + str(len(job_response['data'])))
+else:
+    print(json.dumps(job_response['data']))
@@ -0,0 +1,721 @@
+### Example of a long-running service that keeps the device and group inventory warm in memory, refreshes it in
+### the background, and runs query, cleanup and sync jobs sent by ax-device-inventory-client.py over a local socket.
+import socketserver
+import collections
+import functools
+import threading
+import datetime
+import requests
+import argparse
+import atexit
+import time
+import json
+import hmac
+import math
+import sys
+import re
+
+# --Function Block--#
+
+# Shared HTTP session so every API call reuses pooled keep-alive connections (and TLS sessions)
+ax_session = requests.Session()
+
+# Exit handler (Error)
+def ax_exit_error(error_code, error_message=None, system_message=None):
+    print(error_code)
+    if error_message is not None:
+        print(error_message)
+    if system_message is not None:
+        print(system_message)
+    sys.exit(1)
+
+# Profiling state, only populated when the run is started with -profile
+ax_profile_state = {'profiler': None, 'profile_file': None, 'phase': None, 'phase_start': None, 'phase_times': {}}
+
+# Start profiling the run and write the report when the script exits (including error exits)
+def ax_profile_start(profile_file):
+    # Imported here so runs without -profile don't pay for loading the profiler
+    import cProfile
+    ax_profile_state['profile_file'] = profile_file
+    ax_profile_state['profiler'] = cProfile.Profile()
+    atexit.register(ax_profile_stop)
+    ax_profile_state['profiler'].enable()
+
+# Mark the start of a run phase (fetch, plan, apply, etc.), closing the previous one
+def ax_profile_phase(phase_name):
+    if ax_profile_state['profiler'] is None:
+        return
+    now = time.perf_counter()
+    if ax_profile_state['phase'] is not None:
+        ax_profile_phase_add(ax_profile_state['phase'], now - ax_profile_state['phase_start'])
+    ax_profile_state['phase'] = phase_name
+    ax_profile_state['phase_start'] = now
+
+# Add time to a phase directly (used for decode time, which is nested inside other phases)
+def ax_profile_phase_add(phase_name, seconds):
+    if ax_profile_state['profiler'] is None:
+        return
+    phase_times = ax_profile_state['phase_times']
+    phase_times[phase_name] = phase_times.get(phase_name, 0.0) + seconds
+
+# Stop profiling, write the profile file and the phase timing summary
+def ax_profile_stop():
+    # Imported here so runs without -profile don't pay for loading pstats
+    import pstats
+    profiler = ax_profile_state['profiler']
+    if profiler is None:
+        return
+    profiler.disable()
+    ax_profile_phase(None)
+    ax_profile_state['profiler'] = None
+    profile_file = ax_profile_state['profile_file']
+    profiler.dump_stats(profile_file)
+
+    summary_lines = ["Phase timing summary (seconds, decode is included in the phase that made the call):"]
+    for phase_name, seconds in ax_profile_state['phase_times'].items():
+        summary_lines.append("  {:<10} {:>10.3f}".format(phase_name, seconds))
+    print()
+    print("\n".join(summary_lines))
+    print("Profile written to " + profile_file + " (phase summary and top functions in " + profile_file + ".txt)")
+    with open(profile_file + ".txt", mode='w') as summary_file:
+        summary_file.write("\n".join(summary_lines) + "\n\n")
+        pstats.Stats(profiler, stream=summary_file).sort_stats('cumulative').print_stats(25)
+
+# Main API Call Function
+def ax_call_api(action, api_url, ax_api_key, data=None, params=None, try_count=0, max_retries=2):
+    retry_statuses = [429, 500, 502, 503, 504]
+    retry_wait_timer = 5
+    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer ' + ax_api_key}
+
+    # Make the API Call
+    response = ax_session.request(action, api_url, params=params, headers=headers, data=json.dumps(data))
+
+    # Check for an error to retry, re-auth, or fail
+    if response.status_code in retry_statuses:
+        try_count = try_count + 1
+        if try_count <= max_retries:
+            time.sleep(retry_wait_timer)
+            return ax_call_api(action=action, api_url=api_url, ax_api_key=ax_api_key, data=data, params=params,
+                               try_count=try_count, max_retries=max_retries)
+        else:
+            if not response:
+                print(response.json())
+            response.raise_for_status()
+    else:
+        if not response:
+                print(response.json())
+        response.raise_for_status()
+
+    # Check for valid response and catch if blank or unexpected
+    api_response_package = {}
+    api_response_package['statusCode'] = response.status_code
+    decode_start = time.perf_counter()
+    try:
+        api_response_package['data'] = response.json()
+    except ValueError:
+        if response.text == '':
+            api_response_package['data'] = None
+        else:
+            ax_exit_error(501, 'The server returned an unexpected server response.')
+    ax_profile_phase_add('decode', time.perf_counter() - decode_start)
+    return api_response_package
+
+# Page wrapper for API Call
+def ax_call_api_page(action, api_url, ax_api_key, data=None, params={}, max_retries=2):
+    # Validate (or set) Params defaults
+    if not params:
+        params = {}
+    if 'limit' not in params:
+        params['limit'] = "500"
+    if 'page' not in params:
+        params['page'] = "0"
+    limit_int = int(params['limit'])
+    page_int = int(params['page'])
+
+    full_data_list = []
+    # Loop through pages, if needed
+    while True:
+        api_response_package = ax_call_api(action, api_url, ax_api_key, data=data, params=params, max_retries=max_retries)
+        if api_response_package['data']:
+            full_data_list.extend(api_response_package['data'])
+            if len(api_response_package['data']) < limit_int:
+                api_response_package['data'] = full_data_list
+                return api_response_package
+            page_int = page_int + 1
+            params['page'] = str(page_int)
+        else:
+            return api_response_package
+
+# Get a single device (with details)
+def ax_device_get(ax_environment, ax_device_id):
+    url = "https://console.automox.com/api/servers/" + str(ax_device_id)
+    querystring = {"o":ax_environment['automox-org-id']}
+    action = "GET"
+    # Call the API
+    return ax_call_api(action, url, ax_environment['automox-api-key'], params=querystring)['data']
+
+# Get Devices list(with details)
+def ax_device_list_get(ax_environment):
+    url = "https://console.automox.com/api/servers"
+    querystring = {"o":ax_environment['automox-org-id']}
+    action = "GET"
+    # Call the API
+    ax_devices_response = ax_call_api_page(action, url, ax_environment['automox-api-key'], params=querystring)
+    return ax_devices_response['data']
+
+# Modify device
+def ax_device_put(ax_environment, ax_device_id, server_group_id=None, ip_addrs=None, exception=None, tags=None, custom_name=None):
+    url = "https://console.automox.com/api/servers/" + str(ax_device_id)
+    querystring = {"o":ax_environment['automox-org-id']}
+    action = "PUT"
+    # Build the update package
+    update_data = {}
+    if server_group_id:
+        update_data['server_group_id'] = server_group_id
+    if ip_addrs:
+        update_data['ip_addrs'] = ip_addrs
+    if exception:
+        update_data['exception'] = exception
+    if tags:
+        update_data['tags'] = tags
+    if custom_name:
+        update_data['custom_name'] = custom_name
+    # Call the API
+    return ax_call_api(action, url, ax_environment['automox-api-key'], params=querystring, data=update_data)
+
+# Delete Device
+def ax_device_delete(ax_environment, ax_device_id):
+    url = "https://console.automox.com/api/servers/" + str(ax_device_id)
+    querystring = {"o":ax_environment['automox-org-id']}
+    action = "DELETE"
+    # Call the API
+    return ax_call_api(action, url, ax_environment['automox-api-key'], params=querystring)
+
+# Get groups list
+def ax_group_list_get(ax_environment):
+    url = "https://console.automox.com/api/servergroups"
+    querystring = {"o":ax_environment['automox-org-id']}
+    action = "GET"
+    # Call the API
+    ax_devices_response = ax_call_api_page(action, url, ax_environment['automox-api-key'], params=querystring)
+    return ax_devices_response['data']
+
+# Check for duplicates in a list
+def duplicate_check(object_list):
+    object_set = set()
+    for single_object in object_list:
+        if single_object in object_set:
+            return single_object
+        else:
+            object_set.add(single_object)
+    return None
+
+# Fields of a planned device update that ax_device_put can send
+ax_device_put_fields = ('server_group_id', 'ip_addrs', 'exception', 'tags', 'custom_name')
+
+# Merge a set of field changes into the per-device change plan (one entry per device id)
+def ax_change_plan_add(change_plan, device, update_data):
+    if device['id'] not in change_plan:
+        planned_device = {}
+        planned_device['display_name'] = device['display_name']
+        planned_device['id'] = device['id']
+        # The API expects the group on every update, so start from the current one
+        planned_device['server_group_id'] = device['server_group_id']
+        change_plan[device['id']] = planned_device
+    change_plan[device['id']].update(update_data)
+    return change_plan[device['id']]
+
+# Re-plan a device update against the device's current record (the warm inventory the plan was made from can be minutes old)
+# Keeps the planned owner tag and group and takes everything else from the current record; None if nothing is left to change
+def ax_device_update_refresh(planned_device, current_device):
+    refreshed_device = {}
+    refreshed_device['display_name'] = current_device['display_name']
+    refreshed_device['id'] = current_device['id']
+    refreshed_device['server_group_id'] = planned_device.get('planned_server_group_id', current_device['server_group_id'])
+    if 'owner_tag' in planned_device and planned_device['owner_tag'] not in current_device['tags']:
+        refreshed_device['tags'] = [tag for tag in current_device['tags'] if not tag.startswith(planned_device['tag_header'])] + [planned_device['owner_tag']]
+    if 'tags' not in refreshed_device and refreshed_device['server_group_id'] == current_device['server_group_id']:
+        return None
+    return refreshed_device
+
+# Pattern for the API timestamp format (optional fractional seconds and optional Z / +HH / +HHMM / +HH:MM offset)
+ax_timestamp_pattern = re.compile(r'^(\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2})(?:\.(\d+))?(Z|[+-]\d{2}(?::?\d{2})?)?$')
+
+# Parse an API timestamp into an aware UTC datetime (cached, as many devices share the same timestamps)
+@functools.lru_cache(maxsize=65536)
+def ax_timestamp_parse(timestamp):
+    timestamp_match = ax_timestamp_pattern.match(timestamp)
+    if not timestamp_match:
+        raise ValueError("Unexpected timestamp format: " + timestamp)
+    date_time, fraction, offset = timestamp_match.groups()
+    # Normalize to what fromisoformat accepts on every Python 3 version (6 digit fraction, +HH:MM offset)
+    if fraction:
+        date_time = date_time + "." + fraction[:6].ljust(6, "0")
+    if offset is None or offset == 'Z':
+        offset = "+00:00"
+    elif len(offset) == 3:
+        offset = offset + ":00"
+    elif ':' not in offset:
+        offset = offset[:3] + ":" + offset[3:]
+    return datetime.datetime.fromisoformat(date_time + offset).astimezone(datetime.timezone.utc)
+
+
+# Check whether a device's agent is connected right now (the record's connected flag, or its agent status)
+def ax_device_connected(device):
+    if device.get('connected'):
+        return True
+    return (device.get('status') or {}).get('agent_status') == 'connected'
+
+# Check that a freshly fetched device is still disconnected, and has been since before the cutoff
+def ax_device_disconnected_since(device, cutoff_time):
+    if not device or ax_device_connected(device) or device.get('last_disconnect_time') is None:
+        return False
+    try:
+        return ax_timestamp_parse(device['last_disconnect_time']) < cutoff_time
+    except ValueError:
+        return False
+
+# Normalize a hostname for matching (trim, case fold, drop trailing dot and the domain part of an FQDN)
+# Matches on it are only kept when the domains agree (see ax_hostname_domains_agree)
+def ax_hostname_normalize(hostname):
+    hostname = hostname.strip().casefold().rstrip('.')
+    hostname_parts = hostname.split('.')
+    # Leave IP addresses whole
+    if all(hostname_part.isdigit() for hostname_part in hostname_parts):
+        return hostname
+    return hostname_parts[0]
+
+# Get the domain part of a hostname ('' for a short name or an IP address)
+def ax_hostname_domain(hostname):
+    hostname = hostname.strip().casefold().rstrip('.')
+    hostname_parts = hostname.split('.')
+    if all(hostname_part.isdigit() for hostname_part in hostname_parts):
+        return ''
+    return '.'.join(hostname_parts[1:])
+
+# Check two hostname domains can belong to the same host - a short name fits any domain, otherwise one domain has
+# to be the other or the start of it (ex. 'prod' and 'prod.example.com'), so web01.prod and web01.dev never match
+def ax_hostname_domains_agree(domain, other_domain):
+    if not domain or not other_domain or domain == other_domain:
+        return True
+    return domain.startswith(other_domain + '.') or other_domain.startswith(domain + '.')
+
+# Split a normalized hostname into its set of trigrams (padded so short names still have some)
+def ax_hostname_trigrams(hostname):
+    padded_hostname = "  " + hostname + " "
+    return set(padded_hostname[position:position + 3] for position in range(len(padded_hostname) - 2))
+
+# Build the hostname matching index for a device list (exact, normalized and, if asked for, trigram lookups)
+def ax_hostname_index_build(device_list, fuzzy=False):
+    hostname_index = {'exact': {}, 'normalized': {}, 'trigrams': None, 'trigram_sets': None}
+    for device in device_list:
+        hostname_index['exact'].setdefault(device['display_name'].lower(), []).append(device)
+        hostname_index['normalized'].setdefault(ax_hostname_normalize(device['display_name']), []).append(device)
+    if fuzzy:
+        hostname_index['trigrams'] = {}
+        hostname_index['trigram_sets'] = {}
+        for normalized_name in hostname_index['normalized']:
+            name_trigrams = ax_hostname_trigrams(normalized_name)
+            hostname_index['trigram_sets'][normalized_name] = name_trigrams
+            for trigram in name_trigrams:
+                hostname_index['trigrams'].setdefault(trigram, []).append(normalized_name)
+    return hostname_index
+
+# Similarity margin a fuzzy match has to win by - anything scoring within it of the best name counts as a tie
+ax_hostname_fuzzy_margin = 0.05
+
+# Find the device(s) for a hostname - exact (case insensitive) first, then normalized, then trigram similarity
+# Returns the match type ('exact', 'normalized', 'fuzzy', 'ambiguous' or None) and the matched devices
+def ax_hostname_index_match(hostname_index, hostname, fuzzy_threshold=None):
+    matched_devices = hostname_index['exact'].get(hostname.lower())
+    if matched_devices:
+        return 'exact', matched_devices
+
+    normalized_name = ax_hostname_normalize(hostname)
+    hostname_domain = ax_hostname_domain(hostname)
+    matched_devices = [device for device in hostname_index['normalized'].get(normalized_name, [])
+                       if ax_hostname_domains_agree(hostname_domain, ax_hostname_domain(device['display_name']))]
+    if matched_devices:
+        # Same short name on different FQDNs can't be told apart
+        if len(set(device['display_name'].lower() for device in matched_devices)) > 1:
+            return 'ambiguous', matched_devices
+        return 'normalized', matched_devices
+
+    if fuzzy_threshold is None or hostname_index['trigrams'] is None:
+        return None, []
+
+    # A name needs at least min_shared trigrams in common to reach a score, so candidates only have to be collected
+    # from the rarest (count - min_shared + 1) trigrams - the common ones ('  w', 'web', ...) are skipped
+    name_trigrams = ax_hostname_trigrams(normalized_name)
+    rare_trigrams = sorted(name_trigrams, key=lambda trigram: len(hostname_index['trigrams'].get(trigram, ())))
+    candidate_scores = {}
+    collected_count = 0
+
+    # Score the candidates with the Dice coefficient - first those that can reach the threshold, then (once the best
+    # score is known) any others that can land within the margin of it
+    for min_score in (fuzzy_threshold, None):
+        if min_score is None:
+            best_score = max(candidate_scores.values(), default=0.0)
+            if best_score < fuzzy_threshold:
+                return None, []
+            min_score = max(best_score - ax_hostname_fuzzy_margin, 0.0)
+        min_shared = math.ceil(min_score * len(name_trigrams) / (2.0 - min_score))
+        for trigram in rare_trigrams[collected_count:len(name_trigrams) - min_shared + 1]:
+            for candidate_name in hostname_index['trigrams'].get(trigram, ()):
+                if candidate_name not in candidate_scores:
+                    candidate_trigrams = hostname_index['trigram_sets'][candidate_name]
+                    candidate_scores[candidate_name] = 2.0 * len(name_trigrams & candidate_trigrams) / (len(name_trigrams) + len(candidate_trigrams))
+        collected_count = max(collected_count, len(name_trigrams) - min_shared + 1)
+    best_names = [candidate_name for candidate_name, score in candidate_scores.items() if score > best_score - ax_hostname_fuzzy_margin]
+    matched_devices = []
+    for best_name in best_names:
+        matched_devices.extend(device for device in hostname_index['normalized'][best_name]
+                               if ax_hostname_domains_agree(hostname_domain, ax_hostname_domain(device['display_name'])))
+    if not matched_devices:
+        return None, []
+    if len(set(device['display_name'].lower() for device in matched_devices)) > 1:
+        return 'ambiguous', matched_devices
+    return 'fuzzy', matched_devices
+
+# Find the CSV rows that resolve to the same device as another row (ex. host01 and host01.corp.com)
+# Takes the hostname and matched device ids of each row, returns {row position: hostnames of the other rows}
+def ax_hostname_row_conflicts(hostnames, row_device_ids):
+    device_rows = {}
+    for row_position, device_ids in enumerate(row_device_ids):
+        for device_id in device_ids:
+            device_rows.setdefault(device_id, set()).add(row_position)
+    row_conflicts = {}
+    for row_positions in device_rows.values():
+        if len(row_positions) > 1:
+            for row_position in row_positions:
+                row_conflicts.setdefault(row_position, set()).update(row_positions - {row_position})
+    return {row_position: sorted(hostnames[other_position] for other_position in other_positions) for row_position, other_positions in row_conflicts.items()}
+
+# In-memory inventory shared by the refresh thread and the job handlers
+ax_inventory = {'devices': [], 'groups': [], 'hostname_index': ax_hostname_index_build([]), 'group_name_index': {}, 'refreshed': None}
+ax_inventory_lock = threading.Lock()
+
+# Write jobs and inventory refreshes are run one at a time, so two syncs never race on the same devices and the
+# refresh thread never shares the API session with a running job
+ax_write_job_lock = threading.Lock()
+
+# Jobs that change devices, which the service only runs when it was started with -token
+ax_token_jobs = ('cleanup', 'sync')
+
+# Build the lookup indexes for a device and group list
+def ax_inventory_index(device_list, group_list):
+    # The service pays for the trigram index once per refresh, so fuzzy matching is always available to sync jobs
+    hostname_index = ax_hostname_index_build(device_list, fuzzy=True)
+    group_name_index = {}
+    for group in group_list:
+        if group['name']:
+            group_name_index[group['name']] = group['id']
+    return hostname_index, group_name_index
+
+# Swap a new device and group list (and their indexes) into the inventory
+def ax_inventory_replace(device_list, group_list):
+    hostname_index, group_name_index = ax_inventory_index(device_list, group_list)
+    with ax_inventory_lock:
+        ax_inventory['devices'] = device_list
+        ax_inventory['groups'] = group_list
+        ax_inventory['hostname_index'] = hostname_index
+        ax_inventory['group_name_index'] = group_name_index
+        ax_inventory['refreshed'] = datetime.datetime.now(datetime.timezone.utc)
+
+# Fetch the device and group lists from the API into the inventory
+def ax_inventory_refresh(ax_environment):
+    ax_profile_phase('fetch')
+    device_list = ax_device_list_get(ax_environment) or []
+    group_list = ax_group_list_get(ax_environment) or []
+    ax_profile_phase('index')
+    ax_inventory_replace(device_list, group_list)
+    ax_profile_phase('idle')
+    print(datetime.datetime.now(), "- Inventory refreshed: " + str(len(device_list)) + " devices, " + str(len(group_list)) + " groups.")
+
+# Background loop that keeps the inventory warm
+def ax_inventory_refresh_loop(ax_environment, refresh_seconds, stop_event):
+    while not stop_event.wait(refresh_seconds):
+        try:
+            with ax_write_job_lock:
+                ax_inventory_refresh(ax_environment)
+        except (Exception, SystemExit) as refresh_error:
+            # Keep serving the last good inventory and try again on the next interval
+            print(datetime.datetime.now(), "- Inventory refresh failed, keeping the previous inventory:", refresh_error)
+
+# Job: inventory status
+def ax_job_status(ax_environment, job):
+    with ax_inventory_lock:
+        status_data = {}
+        status_data['devices'] = len(ax_inventory['devices'])
+        status_data['groups'] = len(ax_inventory['groups'])
+        status_data['refreshed'] = ax_inventory['refreshed'].isoformat() if ax_inventory['refreshed'] else None
+    return [], status_data
+
+# Job: refresh the inventory now
+def ax_job_refresh(ax_environment, job):
+    ax_inventory_refresh(ax_environment)
+    return ax_job_status(ax_environment, job)
+
+# Job: query the device list (by name and/or group), optionally names only
+def ax_job_query(ax_environment, job):
+    with ax_inventory_lock:
+        if job.get('display_name'):
+            device_list = list(ax_inventory['hostname_index']['exact'].get(job['display_name'].lower(), []))
+        else:
+            device_list = list(ax_inventory['devices'])
+    if job.get('groupId'):
+        device_list = [device for device in device_list if device['server_group_id'] == job['groupId']]
+    if job.get('names_only'):
+        return [], [device['display_name'] for device in device_list]
+    return [], device_list
+
+# Job: find (and optionally remove) duplicate devices disconnected for longer than the cutoff
+def ax_job_cleanup(ax_environment, job):
+    messages = []
+    cutoff_time = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=job.get('mintuesDisconnectFor', 10))
+    with ax_inventory_lock:
+        device_list = ax_inventory['devices']
+
+    # Duplicates are exact (case sensitive) display name matches, the same as ax-device-remove-disconnected-duplicates.py
+    name_counts = collections.Counter(device['display_name'] for device in device_list)
+    devices_to_remove = []
+    for device in device_list:
+        if device['last_disconnect_time'] is not None and name_counts[device['display_name']] > 1:
+            try:
+                last_disconnect_time = ax_timestamp_parse(device['last_disconnect_time'])
+            except ValueError as timestamp_error:
+                messages.append("Warning - device " + str(device['name']) + " with Device ID " + str(device['id']) + " has a last disconnect time that can't be read (" + str(timestamp_error) + ").  Skipping device.")
+                continue
+            if last_disconnect_time < cutoff_time:
+                devices_to_remove.append(device)
+
+    removed_ids = set()
+    for device in devices_to_remove:
+        if job.get('remove'):
+            # The inventory can be a few minutes old, so check the device's current record before deleting it
+            try:
+                if not ax_device_disconnected_since(ax_device_get(ax_environment, device['id']), cutoff_time):
+                    messages.append("Device " + str(device['name']) + " with Device ID " + str(device['id']) + " is connected again or was disconnected too recently - skipping.")
+                    continue
+                ax_device_delete(ax_environment, device['id'])
+            except (Exception, SystemExit) as device_error:
+                messages.append("Failed - device " + str(device['name']) + " with Device ID " + str(device['id']) + " could not be checked or removed: " + repr(device_error))
+                continue
+            messages.append("removed device from Automox console: " + device['display_name'] + " (Device ID " + str(device['id']) + ")")
+            removed_ids.add(device['id'])
+        else:
+            messages.append("Device " + str(device['name']) + " with Device ID " + str(device['id']) + " would be deleted.")
+
+    if removed_ids:
+        with ax_inventory_lock:
+            device_list = [device for device in ax_inventory['devices'] if device['id'] not in removed_ids]
+            group_list = ax_inventory['groups']
+        ax_inventory_replace(device_list, group_list)
+    if job.get('remove'):
+        return messages, [device['id'] for device in devices_to_remove if device['id'] in removed_ids]
+    return messages, [device['id'] for device in devices_to_remove]
+
+# Match a job hostname, adding a warning or note to the job messages for anything but an exact match
+# Fuzzy matches are only suggestions unless fuzzy_apply is set
+def ax_job_match(hostname_index, hostname, fuzzy_threshold, fuzzy_apply, messages):
+    match_type, matched_devices = ax_hostname_index_match(hostname_index, hostname, fuzzy_threshold)
+    if match_type is None:
+        messages.append("Warning - device " + hostname + " not found in Automox!  Skipping device.")
+        return []
+    if match_type == 'ambiguous':
+        messages.append("Warning - device " + hostname + " matches more than one device (" + ", ".join(sorted(set(device['display_name'] for device in matched_devices))) + ")!  Skipping device.")
+        return []
+    if match_type == 'fuzzy' and not fuzzy_apply:
+        messages.append("Suggestion - device " + hostname + " not found in Automox, closest match is " + matched_devices[0]['display_name'] + ".  Send fuzzy_match_apply to apply fuzzy matches.  Skipping device.")
+        return []
+    if match_type != 'exact':
+        messages.append("Note - device " + hostname + " matched device " + matched_devices[0]['display_name'] + " by " + match_type + " name.")
+    return matched_devices
+
+# Job: sync tags (hostname/owner rows) and groups ("Server"/"Current Schedule (IST)" rows) with one update per device
+def ax_job_sync(ax_environment, job):
+    messages = []
+    tag_header = job.get('tag_header', 'Owner-')
+    tag_rows = job.get('tag_rows', [])
+    group_rows = job.get('group_rows', [])
+
+    duplicate_found = duplicate_check([tag_row[0].lower() for tag_row in tag_rows])
+    if duplicate_found:
+        return ["Found duplicate host name in the tag rows:" + str(duplicate_found)], None
+
+    with ax_inventory_lock:
+        hostname_index = ax_inventory['hostname_index']
+        group_name_index = ax_inventory['group_name_index']
+
+    # Keyed by device id, so every source lands on the same planned update
+    change_plan = {}
+    row_matches = [ax_job_match(hostname_index, tag_row[0], job.get('fuzzy_match_threshold'), job.get('fuzzy_match_apply'), messages) for tag_row in tag_rows]
+    row_conflicts = ax_hostname_row_conflicts([tag_row[0] for tag_row in tag_rows], [[device['id'] for device in matched_devices] for matched_devices in row_matches])
+    for row_position, tag_row in enumerate(tag_rows):
+        if row_position in row_conflicts:
+            messages.append("Warning - device " + tag_row[0] + " matches the same device as " + ", ".join(row_conflicts[row_position]) + "!  Skipping device.")
+            continue
+        owner_tag = tag_header + tag_row[1]
+        for device in row_matches[row_position]:
+            tags_new = [tag for tag in device['tags'] if not tag.startswith(tag_header)]
+            if owner_tag not in device['tags']:
+                tags_new.append(owner_tag)
+                ax_change_plan_add(change_plan, device, {'tags': tags_new, 'owner_tag': owner_tag, 'tag_header': tag_header})
+
+    row_matches = [ax_job_match(hostname_index, group_row['Server'], job.get('fuzzy_match_threshold'), job.get('fuzzy_match_apply'), messages) for group_row in group_rows]
+    row_conflicts = ax_hostname_row_conflicts([group_row['Server'] for group_row in group_rows], [[device['id'] for device in matched_devices] for matched_devices in row_matches])
+    for row_position, group_row in enumerate(group_rows):
+        if row_position in row_conflicts:
+            messages.append("Warning - device " + group_row['Server'] + " matches the same device as " + ", ".join(row_conflicts[row_position]) + "!  Skipping device.")
+            continue
+        for device in row_matches[row_position]:
+            if group_row['Current Schedule (IST)'] not in group_name_index:
+                messages.append("Warning - group " + group_row['Current Schedule (IST)'] + " not found in existing group list!  Skipping device " + device['display_name'])
+            elif group_name_index[group_row['Current Schedule (IST)']] != device['server_group_id']:
+                server_group_id = group_name_index[group_row['Current Schedule (IST)']]
+                ax_change_plan_add(change_plan, device, {'server_group_id': server_group_id, 'planned_server_group_id': server_group_id})
+
+    # The plan was made against the warm inventory, so only the planned devices are fetched again and re-planned from
+    # their current record before they are written (a device that fails is reported and the rest carry on)
+    current_devices = {}
+    updated_ids = []
+    failed_count = 0
+    for planned_device in change_plan.values():
+        try:
+            current_device = ax_device_get(ax_environment, planned_device['id'])
+            refreshed_device = ax_device_update_refresh(planned_device, current_device)
+            if refreshed_device is None:
+                messages.append("Device " + planned_device['display_name'] + " already has the planned changes - skipping.")
+            else:
+                ax_device_put(ax_environment, refreshed_device['id'], **{field: value for field, value in refreshed_device.items() if field in ax_device_put_fields})
+                messages.append("Updated device " + planned_device['display_name'])
+                current_device = dict(current_device, **{field: value for field, value in refreshed_device.items() if field in ('server_group_id', 'tags')})
+                updated_ids.append(planned_device['id'])
+        except (Exception, SystemExit) as device_error:
+            messages.append("Failed - device " + planned_device['display_name'] + " could not be updated: " + repr(device_error))
+            failed_count = failed_count + 1
+            continue
+        current_devices[planned_device['id']] = current_device
+    if failed_count:
+        messages.append("Warning - " + str(failed_count) + " of " + str(len(change_plan)) + " device updates failed.")
+
+    # Keep the warm inventory in step with the devices' current records and what was just written
+    with ax_inventory_lock:
+        for device in ax_inventory['devices']:
+            if device['id'] in current_devices:
+                device['server_group_id'] = current_devices[device['id']]['server_group_id']
+                device['tags'] = current_devices[device['id']]['tags']
+    return messages, updated_ids
+
+ax_jobs = {'status': ax_job_status, 'refresh': ax_job_refresh, 'query': ax_job_query, 'cleanup': ax_job_cleanup, 'sync': ax_job_sync}
+
+# Check a job's token against the service token (constant time, so the comparison doesn't leak how much matched)
+def ax_job_token_valid(job_token, service_token):
+    if service_token is None:
+        return False
+    return hmac.compare_digest(str(job_token or '').encode('utf-8'), service_token.encode('utf-8'))
+
+# Socket handler - one JSON request line in, one JSON response line out
+class AxJobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        job_response = {'status': 'error', 'messages': [], 'data': None}
+        try:
+            job = json.loads(self.rfile.readline())
+            token_valid = ax_job_token_valid(job.get('token'), self.server.ax_token)
+            if self.server.ax_token and not token_valid:
+                job_response['messages'].append("Invalid token.")
+            elif job.get('job') in ax_token_jobs and not token_valid:
+                job_response['messages'].append("The " + job['job'] + " job changes devices, so the service has to be started with -token to run it.")
+            elif job.get('job') not in ax_jobs:
+                job_response['messages'].append("Unknown job: " + str(job.get('job')) + ".  Valid jobs: " + ", ".join(ax_jobs))
+            else:
+                job_start = time.perf_counter()
+                if job['job'] in ('cleanup', 'sync', 'refresh'):
+                    with ax_write_job_lock:
+                        job_response['messages'], job_response['data'] = ax_jobs[job['job']](self.server.ax_environment, job)
+                else:
+                    job_response['messages'], job_response['data'] = ax_jobs[job['job']](self.server.ax_environment, job)
+                job_response['status'] = 'ok'
+                print(datetime.datetime.now(), "- Job " + job['job'] + " done in " + "{:.3f}".format(time.perf_counter() - job_start) + "s")
+        except (Exception, SystemExit) as job_error:
+            job_response['messages'].append("Job failed: " + repr(job_error))
+        self.wfile.write((json.dumps(job_response) + "\n").encode('utf-8'))
+
+# Threaded TCP server that carries the environment and token for the handlers
+class AxJobServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+# --Execution Block-- #
+# --Parse command line arguments-- #
+parser = argparse.ArgumentParser()
+
+parser.add_argument(
+    'ax_org_id',
+    type=str,
+    help='Automox Org ID.')
+
+parser.add_argument(
+    'ax_api_key',
+    type=str,
+    help='Automox API Key.')
+
+parser.add_argument(
+    '-port',
+    type=int,
+    default=8765,
+    help='(Optional - Default to 8765)  Local port to accept jobs on (only bound to 127.0.0.1).')
+
+parser.add_argument(
+    '-refresh_minutes',
+    type=int,
+    default=5,
+    help='(Optional - Default to 5)  Minutes between background inventory refreshes.')
+
+parser.add_argument(
+    '-token',
+    type=str,
+    help='(Optional) Shared token that clients must send with every job.  Without it the service only runs the status, refresh and query jobs.')
+
+parser.add_argument(
+    '-profile',
+    type=str,
+    help='(Optional) Profile the run with cProfile and write the stats to this file (phase timing summary goes to <file>.txt).')
+
+args = parser.parse_args()
+# --End parse command line arguments-- #
+
+# --Main-- #
+
+# Create environment dict & vars
+ax_environment = {}
+ax_environment['automox-org-id'] = args.ax_org_id
+ax_environment['automox-api-key'] = args.ax_api_key
+
+if args.profile:
+    ax_profile_start(args.profile)
+
+current_datetime = datetime.datetime.now()
+print("Current date and time:", current_datetime)
+
+print("Calling the API to load the device and group inventory...")
+ax_inventory_refresh(ax_environment)
+
+stop_event = threading.Event()
+refresh_thread = threading.Thread(target=ax_inventory_refresh_loop, args=(ax_environment, args.refresh_minutes * 60, stop_event), daemon=True)
+refresh_thread.start()
+
+job_server = AxJobServer(('127.0.0.1', args.port), AxJobHandler)
+job_server.ax_environment = ax_environment
+job_server.ax_token = args.token
+print("Accepting jobs on 127.0.0.1:" + str(args.port) + " (Ctrl+C to stop)...")
+try:
+    job_server.serve_forever()
+except KeyboardInterrupt:
+    print()
+    print("Stopping...")
+finally:
+    stop_event.set()
+    job_server.server_close()
+print("Done!")
@@ -0,0 +1,133 @@
+### Benchmark for the start up cost of quick ax-device-list-with-query.py runs.  Runs "-snapshot <file> -names_only" under -X importtime against a generated snapshot, checks the import time against a budget and checks that requests is never imported.
+
+import subprocess
+import argparse
+import tempfile
+import time
+import sys
+import os
+
+# --Function Block--#
+
+# Exit handler (Error)
+def ax_exit_error(error_code, error_message=None, system_message=None):
+    print(error_code)
+    if error_message is not None:
+        print(error_message)
+    if system_message is not None:
+        print(system_message)
+    sys.exit(1)
+
+# Load the list script's function block (everything before its execution block) so the snapshot is written by the same code that reads it
+def ax_list_script_functions(list_script):
+    with open(list_script, mode='r', encoding='utf-8') as list_handle:
+        list_source = list_handle.read()
+    if '# --Execution Block-- #' not in list_source:
+        ax_exit_error(400, "Could not find the execution block in " + list_script + ".")
+    list_functions = {'__name__': 'ax_device_list_with_query', '__file__': list_script}
+    exec(compile(list_source.split('# --Execution Block-- #')[0], list_script, 'exec'), list_functions)
+    return list_functions
+
+# Write a snapshot of generated devices for the runs to load
+def ax_benchmark_snapshot_write(list_script, snapshot_file, device_count):
+    list_functions = ax_list_script_functions(list_script)
+    device_list = [{'id': device_number + 1, 'display_name': 'host' + str(device_number).zfill(6) + '.corp.example.com', 'name': 'host' + str(device_number).zfill(6),
+                    'server_group_id': 1 + device_number % 10, 'tags': ['Owner-team' + str(device_number % 25)], 'last_disconnect_time': None}
+                   for device_number in range(device_count)]
+    list_functions['ax_snapshot_write'](snapshot_file, device_list)
+
+# Read the -X importtime report from a run's stderr: total import time (sum of the top level cumulative times, in ms) and the modules imported
+def ax_import_report_read(import_report):
+    import_total = 0
+    module_names = set()
+    for report_line in import_report.splitlines():
+        if not report_line.startswith('import time:') or 'self [us]' in report_line:
+            continue
+        report_fields = report_line[len('import time:'):].split('|')
+        if len(report_fields) != 3:
+            continue
+        module_name = report_fields[2].rstrip()
+        module_names.add(module_name.strip())
+        # Nested imports are indented under their parent and already counted in its cumulative time
+        if not module_name.startswith('  '):
+            import_total = import_total + int(report_fields[1])
+    return import_total / 1000, module_names
+
+# Run the list script once and return (import time ms, wall time ms, modules imported)
+def ax_benchmark_run(list_script, snapshot_file):
+    run_command = [sys.executable, '-X', 'importtime', list_script, 'benchmark-org', 'benchmark-key', '-snapshot', snapshot_file, '-names_only']
+    run_start = time.perf_counter()
+    run_result = subprocess.run(run_command, capture_output=True, text=True)
+    run_time = (time.perf_counter() - run_start) * 1000
+    if run_result.returncode != 0:
+        ax_exit_error(500, "The list script failed (exit code " + str(run_result.returncode) + ").", run_result.stdout + run_result.stderr)
+    import_time, module_names = ax_import_report_read(run_result.stderr)
+    return import_time, run_time, module_names
+
+# --Execution Block-- #
+# --Parse command line arguments-- #
+parser = argparse.ArgumentParser()
+
+parser.add_argument(
+    '-list_script',
+    type=str,
+    default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ax-device-list-with-query.py'),
+    help='(Optional - Default to ax-device-list-with-query.py next to this script)  The list script to benchmark.')
+
+parser.add_argument(
+    '-snapshot',
+    type=str,
+    help='(Optional) Snapshot file to load in the runs.  A snapshot of generated devices (-device_count) is written to a temp file when not set.')
+
+parser.add_argument(
+    '-device_count',
+    type=int,
+    default=1000,
+    help='(Optional - Default to 1000)  Devices in the generated snapshot.')
+
+parser.add_argument(
+    '-runs',
+    type=int,
+    default=5,
+    help='(Optional - Default to 5)  Runs to time.  The fastest run is checked against the budget, so a busy machine is less likely to fail it.')
+
+parser.add_argument(
+    '-budget_ms',
+    type=float,
+    default=60.0,
+    help='(Optional - Default to 60)  Most import time (ms, as reported by -X importtime) a run may take.  About 42ms was measured after the lazy import change, against about 107ms before it.')
+
+args = parser.parse_args()
+# --End parse command line arguments-- #
+
+# --Main-- #
+
+snapshot_directory = None
+snapshot_file = args.snapshot
+if snapshot_file is None:
+    snapshot_directory = tempfile.TemporaryDirectory()
+    snapshot_file = os.path.join(snapshot_directory.name, 'benchmark.snap')
+    ax_benchmark_snapshot_write(args.list_script, snapshot_file, args.device_count)
+
+run_results = []
+try:
+    for run_number in range(max(1, args.runs)):
+        run_results.append(ax_benchmark_run(args.list_script, snapshot_file))
+        print("Run " + str(run_number + 1) + ": import " + "{:.1f}".format(run_results[-1][0]) + "ms, wall " + "{:.1f}".format(run_results[-1][1]) + "ms")
+finally:
+    if snapshot_directory is not None:
+        snapshot_directory.cleanup()
+
+import_time_best = min(run_result[0] for run_result in run_results)
+run_time_best = min(run_result[1] for run_result in run_results)
+requests_imported = any('requests' in run_result[2] for run_result in run_results)
+
+print("Fastest run: import " + "{:.1f}".format(import_time_best) + "ms (budget " + "{:.1f}".format(args.budget_ms) + "ms), wall " + "{:.1f}".format(run_time_best) + "ms")
+benchmark_failures = []
+if import_time_best > args.budget_ms:
+    benchmark_failures.append("Import time " + "{:.1f}".format(import_time_best) + "ms is over the " + "{:.1f}".format(args.budget_ms) + "ms budget.")
+if requests_imported:
+    benchmark_failures.append("requests was imported by a -snapshot -names_only run (it should only be imported on the first API call).")
+if benchmark_failures:
+    ax_exit_error(500, "FAIL", "\n".join(benchmark_failures))
+print("PASS")
@@ -1,13 +1,32 @@
 ### Example of getting a device list with certain filtering.  Also gives the opiton of listing out only the device names using the -names_only switch.
 
-import requests
+import functools
+import datetime
 import argparse
+import atexit
 import time
+import struct
+import mmap
 import json
+import math
 import sys
+import os
+import re
 
 # --Function Block--#
 
+# Shared HTTP session so every API call reuses pooled keep-alive connections (and TLS sessions)
+# Created on first use, so quick runs that never call the API (ex. -snapshot) don't pay for importing requests
+ax_session = None
+
+# Get (or create) the shared HTTP session
+def ax_session_get():
+    global ax_session
+    if ax_session is None:
+        import requests
+        ax_session = requests.Session()
+    return ax_session
+
 # Exit handler (Error)
 def ax_exit_error(error_code, error_message=None, system_message=None):
     print(error_code)
@@ -17,6 +36,58 @@ def ax_exit_error(error_code, error_message=None, system_message=None):
         print(system_message)
     sys.exit(1)
 
+# Profiling state, only populated when the run is started with -profile
+ax_profile_state = {'profiler': None, 'profile_file': None, 'phase': None, 'phase_start': None, 'phase_times': {}}
+
+# Start profiling the run and write the report when the script exits (including error exits)
+def ax_profile_start(profile_file):
+    # Imported here so runs without -profile don't pay for loading the profiler
+    import cProfile
+    ax_profile_state['profile_file'] = profile_file
+    ax_profile_state['profiler'] = cProfile.Profile()
+    atexit.register(ax_profile_stop)
+    ax_profile_state['profiler'].enable()
+
+# Mark the start of a run phase (fetch, plan, apply, etc.), closing the previous one
+def ax_profile_phase(phase_name):
+    if ax_profile_state['profiler'] is None:
+        return
+    now = time.perf_counter()
+    if ax_profile_state['phase'] is not None:
+        ax_profile_phase_add(ax_profile_state['phase'], now - ax_profile_state['phase_start'])
+    ax_profile_state['phase'] = phase_name
+    ax_profile_state['phase_start'] = now
+
+# Add time to a phase directly (used for decode time, which is nested inside other phases)
+def ax_profile_phase_add(phase_name, seconds):
+    if ax_profile_state['profiler'] is None:
+        return
+    phase_times = ax_profile_state['phase_times']
+    phase_times[phase_name] = phase_times.get(phase_name, 0.0) + seconds
+
+# Stop profiling, write the profile file and the phase timing summary
+def ax_profile_stop():
+    # Imported here so runs without -profile don't pay for loading pstats
+    import pstats
+    profiler = ax_profile_state['profiler']
+    if profiler is None:
+        return
+    profiler.disable()
+    ax_profile_phase(None)
+    ax_profile_state['profiler'] = None
+    profile_file = ax_profile_state['profile_file']
+    profiler.dump_stats(profile_file)
+
+    summary_lines = ["Phase timing summary (seconds, decode is included in the phase that made the call):"]
+    for phase_name, seconds in ax_profile_state['phase_times'].items():
+        summary_lines.append("  {:<10} {:>10.3f}".format(phase_name, seconds))
+    print()
+    print("\n".join(summary_lines))
+    print("Profile written to " + profile_file + " (phase summary and top functions in " + profile_file + ".txt)")
+    with open(profile_file + ".txt", mode='w') as summary_file:
+        summary_file.write("\n".join(summary_lines) + "\n\n")
+        pstats.Stats(profiler, stream=summary_file).sort_stats('cumulative').print_stats(25)
+
 # Main API Call Function
 def ax_call_api(action, api_url, ax_api_key, data=None, params=None, try_count=0, max_retries=2):
     retry_statuses = [429, 500, 502, 503, 504]
@@ -24,7 +95,7 @@ def ax_call_api(action, api_url, ax_api_key, data=None, params=None, try_count=0
     headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer ' + ax_api_key}
 
     # Make the API Call
-    response = requests.request(action, api_url, params=params, headers=headers, data=json.dumps(data))
+    response = ax_session_get().request(action, api_url, params=params, headers=headers, data=json.dumps(data))
 
     # Check for an error to retry, re-auth, or fail
     if response.status_code in retry_statuses:
@@ -45,6 +116,7 @@ def ax_call_api(action, api_url, ax_api_key, data=None, params=None, try_count=0
     # Check for valid response and catch if blank or unexpected
     api_response_package = {}
     api_response_package['statusCode'] = response.status_code
+    decode_start = time.perf_counter()
     try:
         api_response_package['data'] = response.json()
     except ValueError:
@@ -52,6 +124,7 @@ def ax_call_api(action, api_url, ax_api_key, data=None, params=None, try_count=0
             api_response_package['data'] = None
         else:
             ax_exit_error(501, 'The server returned an unexpected server response.')
+    ax_profile_phase_add('decode', time.perf_counter() - decode_start)
     return api_response_package
 
 # Page wrapper for API Call
@@ -111,6 +184,128 @@ def ax_device_list_get_filtered(ax_environment, groupId=None, PS_VERSION=None, p
     return ax_devices_response['data']
 
 
+# Pattern for the API timestamp format (optional fractional seconds and optional Z / +HH / +HHMM / +HH:MM offset)
+ax_timestamp_pattern = re.compile(r'^(\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2})(?:\.(\d+))?(Z|[+-]\d{2}(?::?\d{2})?)?$')
+
+# Parse an API timestamp into an aware UTC datetime (cached, as many devices share the same timestamps)
+@functools.lru_cache(maxsize=65536)
+def ax_timestamp_parse(timestamp):
+    timestamp_match = ax_timestamp_pattern.match(timestamp)
+    if not timestamp_match:
+        raise ValueError("Unexpected timestamp format: " + timestamp)
+    date_time, fraction, offset = timestamp_match.groups()
+    # Normalize to what fromisoformat accepts on every Python 3 version (6 digit fraction, +HH:MM offset)
+    if fraction:
+        date_time = date_time + "." + fraction[:6].ljust(6, "0")
+    if offset is None or offset == 'Z':
+        offset = "+00:00"
+    elif len(offset) == 3:
+        offset = offset + ":00"
+    elif ':' not in offset:
+        offset = offset[:3] + ":" + offset[3:]
+    return datetime.datetime.fromisoformat(date_time + offset).astimezone(datetime.timezone.utc)
+
+# Device snapshot layout: a header (magic, device count, time the snapshot was saved, offset of each column region),
+# then one region per column, all little-endian.  Numeric columns are fixed width arrays; string columns are
+# (device count + 1) offsets followed by the UTF-8 string data.  A script only reads and decodes the columns it asks
+# for - each of those is decoded in full when the snapshot is loaded.
+ax_snapshot_magic = b'AXSNAP02'
+ax_snapshot_numeric_columns = {'id': 'q', 'server_group_id': 'q', 'last_disconnect_time': 'd'}
+ax_snapshot_string_columns = ['display_name', 'name', 'tags', 'record']
+ax_snapshot_header = struct.Struct('<8sQd' + 'Q' * (len(ax_snapshot_numeric_columns) + len(ax_snapshot_string_columns)))
+ax_snapshot_tag_separator = '\x1f'
+
+# Read a single column from a memory mapped snapshot
+def ax_snapshot_column(snapshot_map, device_count, region_offset, column_name):
+    if column_name in ax_snapshot_numeric_columns:
+        column_values = struct.unpack_from('<' + str(device_count) + ax_snapshot_numeric_columns[column_name], snapshot_map, region_offset)
+        if column_name == 'last_disconnect_time':
+            column_values = [None if math.isnan(value) else datetime.datetime.fromtimestamp(value, datetime.timezone.utc).isoformat() for value in column_values]
+        return column_values
+
+    string_offsets = struct.unpack_from('<' + str(device_count + 1) + 'Q', snapshot_map, region_offset)
+    data_offset = region_offset + 8 * (device_count + 1)
+    column_values = [snapshot_map[data_offset + string_offsets[position]:data_offset + string_offsets[position + 1]].decode('utf-8')
+                     for position in range(device_count)]
+    if column_name == 'tags':
+        column_values = [value.split(ax_snapshot_tag_separator) if value else [] for value in column_values]
+    return column_values
+
+# Load a device list from a snapshot file, only reading the columns asked for.  With max_age_minutes, refuse a
+# snapshot saved longer ago than that.
+def ax_snapshot_device_list(snapshot_file, column_names, max_age_minutes=None):
+    with open(snapshot_file, mode='rb') as snapshot_handle:
+        snapshot_size = os.fstat(snapshot_handle.fileno()).st_size
+        snapshot_map = mmap.mmap(snapshot_handle.fileno(), 0, access=mmap.ACCESS_READ) if snapshot_size else b''
+    if snapshot_size < ax_snapshot_header.size or snapshot_map[:len(ax_snapshot_magic)] != ax_snapshot_magic:
+        ax_exit_error(400, snapshot_file + " is not a device snapshot file (or was saved by an older version of ax-device-list-with-query.py).")
+    header_values = ax_snapshot_header.unpack_from(snapshot_map, 0)
+    device_count = header_values[1]
+    saved_time = datetime.datetime.fromtimestamp(header_values[2], datetime.timezone.utc)
+    region_offsets = dict(zip(list(ax_snapshot_numeric_columns) + ax_snapshot_string_columns, header_values[3:]))
+
+    snapshot_age = datetime.datetime.now(datetime.timezone.utc) - saved_time
+    print("Snapshot saved at " + str(saved_time) + " (" + str(int(snapshot_age.total_seconds() // 60)) + " minutes ago).")
+    if max_age_minutes is not None and snapshot_age > datetime.timedelta(minutes=max_age_minutes):
+        ax_exit_error(400, snapshot_file + " is older than " + str(max_age_minutes) + " minutes.  Save a new snapshot, or raise -snapshot_max_age to use it anyway.")
+
+    device_list = [{} for position in range(device_count)]
+    for column_name in column_names:
+        column_values = ax_snapshot_column(snapshot_map, device_count, region_offsets[column_name], column_name)
+        for device, value in zip(device_list, column_values):
+            device[column_name] = value
+    return device_list
+
+# Get a device's last disconnect time as epoch seconds for the snapshot (NaN if it has none or it can't be read)
+def ax_snapshot_disconnect_time(device):
+    if not device.get('last_disconnect_time'):
+        return math.nan
+    try:
+        return ax_timestamp_parse(device['last_disconnect_time']).timestamp()
+    except ValueError as timestamp_error:
+        print("Warning - device " + str(device.get('display_name')) + " with Device ID " + str(device.get('id')) + " has a last disconnect time that can't be read (" + str(timestamp_error) + ").  Saving it without one.")
+        return math.nan
+
+# Write a device list to a snapshot file (see the layout above)
+def ax_snapshot_write(snapshot_file, device_list):
+    column_regions = []
+    for column_name, column_format in ax_snapshot_numeric_columns.items():
+        if column_name == 'last_disconnect_time':
+            column_values = [ax_snapshot_disconnect_time(device) for device in device_list]
+        else:
+            column_values = [device.get(column_name) or 0 for device in device_list]
+        column_regions.append(struct.pack('<' + str(len(column_values)) + column_format, *column_values))
+
+    for column_name in ax_snapshot_string_columns:
+        if column_name == 'record':
+            column_values = [json.dumps(device) for device in device_list]
+        elif column_name == 'tags':
+            column_values = [ax_snapshot_tag_separator.join(device.get('tags') or []) for device in device_list]
+        else:
+            column_values = [device.get(column_name) or '' for device in device_list]
+        string_offsets = [0]
+        string_data = bytearray()
+        for value in column_values:
+            string_data.extend(value.encode('utf-8'))
+            string_offsets.append(len(string_data))
+        column_regions.append(struct.pack('<' + str(len(string_offsets)) + 'Q', *string_offsets) + bytes(string_data))
+
+    # Lay the regions out after the header, each on an 8 byte boundary
+    region_offsets = []
+    next_offset = ax_snapshot_header.size
+    for column_region in column_regions:
+        next_offset = next_offset + (-next_offset % 8)
+        region_offsets.append(next_offset)
+        next_offset = next_offset + len(column_region)
+
+    # Write to a temp file first so a reader never sees a half written snapshot
+    with open(snapshot_file + ".tmp", mode='wb') as snapshot_handle:
+        snapshot_handle.write(ax_snapshot_header.pack(ax_snapshot_magic, len(device_list), time.time(), *region_offsets))
+        for region_offset, column_region in zip(region_offsets, column_regions):
+            snapshot_handle.write(b'\0' * (region_offset - snapshot_handle.tell()))
+            snapshot_handle.write(column_region)
+    os.replace(snapshot_file + ".tmp", snapshot_file)
+
 # --Execution Block-- #
 # --Parse command line arguments-- #
 parser = argparse.ArgumentParser()
@@ -180,6 +375,21 @@ parser.add_argument(
     action='store_true',
     help='(Optional-Flag) Only print out the device names as a text list')
 
+parser.add_argument(
+    '-snapshot',
+    type=str,
+    help='(Optional) Load the device list from a snapshot file (written by ax-device-list-with-query.py -snapshot_save) instead of calling the API.')
+
+parser.add_argument(
+    '-snapshot_save',
+    type=str,
+    help='(Optional) Save the full device list fetched from the API to this snapshot file for later runs to load with -snapshot.  Can not be combined with filters.')
+
+parser.add_argument(
+    '-profile',
+    type=str,
+    help='(Optional) Profile the run with cProfile and write the stats to this file (phase timing summary goes to <file>.txt).')
+
 args = parser.parse_args()
 # --End parse command line arguments-- #
 
@@ -190,6 +400,9 @@ ax_environment = {}
 ax_environment['automox-org-id'] = args.ax_org_id
 ax_environment['automox-api-key'] = args.ax_api_key
 
+if args.profile:
+    ax_profile_start(args.profile)
+
 # Fix pass in variables
 """if args.filters_is_compatible:
     filters_is_compatible = "true"
@@ -201,20 +414,46 @@ else:
     patchStatus = None
 
 
-print("Calling the API to get the device list...")
-device_list = ax_device_list_get_filtered(ax_environment, groupId=args.groupId, PS_VERSION=args.PS_VERSION, pending=args.pending, patchStatus=patchStatus,
-                                            policyId=args.policyId, exception=args.exception, managed=args.managed, filters_is_compatible=args.filters_is_compatible,
-                                            sortColumns=args.sortColumns, sortDir=args.sortDir)
+ax_profile_phase('fetch')
+api_only_filters = args.PS_VERSION or args.pending or patchStatus or args.policyId or args.exception or args.managed or args.filters_is_compatible or args.sortColumns or args.sortDir
+if args.snapshot_save and (args.groupId or api_only_filters):
+    # Other scripts load a snapshot as the full device list, so it has to be saved unfiltered
+    ax_exit_error(400, "-snapshot_save saves the full device list and can't be combined with filters or sorting.")
+if args.snapshot:
+    if args.snapshot_save or api_only_filters:
+        ax_exit_error(400, "Only -groupId and -names_only can be used with -snapshot.")
+    print("Loading the device list from snapshot " + args.snapshot + "...")
+    snapshot_columns = ['display_name'] if args.names_only else ['record']
+    if args.groupId:
+        snapshot_columns.append('server_group_id')
+    device_list = ax_snapshot_device_list(args.snapshot, snapshot_columns)
+    if args.groupId:
+        device_list = [device for device in device_list if device['server_group_id'] == args.groupId]
+else:
+    print("Calling the API to get the device list...")
+    device_list = ax_device_list_get_filtered(ax_environment, groupId=args.groupId, PS_VERSION=args.PS_VERSION, pending=args.pending, patchStatus=patchStatus,
+                                                policyId=args.policyId, exception=args.exception, managed=args.managed, filters_is_compatible=args.filters_is_compatible,
+                                                sortColumns=args.sortColumns, sortDir=args.sortDir)
 
+if args.snapshot_save:
+    ax_profile_phase('snapshot')
+    ax_snapshot_write(args.snapshot_save, device_list)
+    print("Saved a snapshot of " + str(len(device_list)) + " devices to " + args.snapshot_save)
+
+ax_profile_phase('output')
 if args.names_only:
     print()
     print("Device Names only flag detected.  Device name list:")
-    for device in device_list:
-        print(device['display_name'])
+    # One write for the whole list instead of a print per device
+    print("\n".join(device['display_name'] for device in device_list))
     print()
     print("Total devices listed: " + str(len(device_list)))
 else:
     print()
     print("Names only flag not detected.  JSON list:")
     print()
-    print(json.dumps(device_list))
+    if args.snapshot:
+        # The snapshot keeps each device's JSON as written, so there is nothing to decode or re-encode
+        print("[" + ", ".join(device['record'] for device in device_list) + "]")
+    else:
+        print(json.dumps(device_list))
@@ -1,12 +1,25 @@
+import collections
+import functools
 import datetime
 import requests
+import concurrent.futures
+import threading
 import argparse
+import atexit
 import time
+import struct
+import mmap
 import json
+import math
 import sys
+import os
+import re
 
 # --Function Block--#
 
+# Shared HTTP session so every API call reuses pooled keep-alive connections (and TLS sessions)
+ax_session = requests.Session()
+
 # Exit handler (Error)
 def ax_exit_error(error_code, error_message=None, system_message=None):
     print(error_code)
@@ -16,14 +29,166 @@ def ax_exit_error(error_code, error_message=None, system_message=None):
         print(system_message)
     sys.exit(1)
 
+# Switch the shared session to an HTTP/2 client (httpx) for -http2, so concurrent bulk writes are multiplexed over one
+# connection (and one TLS session) instead of one HTTP/1.1 connection per worker.  httpx is only needed with -http2
+def ax_session_http2():
+    global ax_session
+    try:
+        import httpx
+        # No timeout and follow redirects, the same as the requests session
+        ax_session = httpx.Client(http2=True, follow_redirects=True, timeout=None)
+    except ImportError as import_error:
+        ax_exit_error(400, "-http2 needs httpx with HTTP/2 support.  Install it with: pip install httpx[http2]", str(import_error))
+
+# Profiling state, only populated when the run is started with -profile
+ax_profile_state = {'profiler': None, 'profile_file': None, 'phase': None, 'phase_start': None, 'phase_times': {}}
+
+# Start profiling the run and write the report when the script exits (including error exits)
+def ax_profile_start(profile_file):
+    # Imported here so runs without -profile don't pay for loading the profiler
+    import cProfile
+    ax_profile_state['profile_file'] = profile_file
+    ax_profile_state['profiler'] = cProfile.Profile()
+    atexit.register(ax_profile_stop)
+    ax_profile_state['profiler'].enable()
+
+# Mark the start of a run phase (fetch, plan, apply, etc.), closing the previous one
+def ax_profile_phase(phase_name):
+    if ax_profile_state['profiler'] is None:
+        return
+    now = time.perf_counter()
+    if ax_profile_state['phase'] is not None:
+        ax_profile_phase_add(ax_profile_state['phase'], now - ax_profile_state['phase_start'])
+    ax_profile_state['phase'] = phase_name
+    ax_profile_state['phase_start'] = now
+
+# Add time to a phase directly (used for decode time, which is nested inside other phases)
+def ax_profile_phase_add(phase_name, seconds):
+    if ax_profile_state['profiler'] is None:
+        return
+    phase_times = ax_profile_state['phase_times']
+    phase_times[phase_name] = phase_times.get(phase_name, 0.0) + seconds
+
+# Stop profiling, write the profile file and the phase timing summary
+def ax_profile_stop():
+    # Imported here so runs without -profile don't pay for loading pstats
+    import pstats
+    profiler = ax_profile_state['profiler']
+    if profiler is None:
+        return
+    profiler.disable()
+    ax_profile_phase(None)
+    ax_profile_state['profiler'] = None
+    profile_file = ax_profile_state['profile_file']
+    profiler.dump_stats(profile_file)
+
+    summary_lines = ["Phase timing summary (seconds, decode is included in the phase that made the call):"]
+    for phase_name, seconds in ax_profile_state['phase_times'].items():
+        summary_lines.append("  {:<10} {:>10.3f}".format(phase_name, seconds))
+    print()
+    print("\n".join(summary_lines))
+    print("Profile written to " + profile_file + " (phase summary and top functions in " + profile_file + ".txt)")
+    with open(profile_file + ".txt", mode='w') as summary_file:
+        summary_file.write("\n".join(summary_lines) + "\n\n")
+        pstats.Stats(profiler, stream=summary_file).sort_stats('cumulative').print_stats(25)
+
+# Adaptive (AIMD) concurrency for bulk writes: the in-flight limit grows by one after a full window of fast, clean
+# calls, drops by one when latency climbs past twice a smoothed (EWMA) baseline, and halves on 429/5xx responses.
+# The baseline follows the API's latency as it drifts, so one unusually fast early call doesn't pin it for the whole run
+ax_concurrency_state = {'limit': 1, 'max_limit': 1, 'peak_limit': 1, 'in_flight': 0, 'window_successes': 0,
+                        'latency_baseline': None, 'last_decrease': 0.0, 'throttled': 0, 'condition': threading.Condition()}
+ax_concurrency_throttle_statuses = [429, 500, 502, 503, 504]
+ax_concurrency_latency_factor = 2.0
+ax_concurrency_latency_smoothing = 0.1
+ax_concurrency_decrease_interval = 1.0
+
+# Record the outcome of one API call attempt and adjust the in-flight limit
+def ax_concurrency_record(status_code, latency):
+    concurrency_state = ax_concurrency_state
+    with concurrency_state['condition']:
+        now = time.monotonic()
+        if status_code in ax_concurrency_throttle_statuses:
+            concurrency_state['throttled'] = concurrency_state['throttled'] + 1
+            concurrency_state['window_successes'] = 0
+            # Calls already in flight report the same overload, so only back off once per interval
+            if now - concurrency_state['last_decrease'] >= ax_concurrency_decrease_interval:
+                concurrency_state['limit'] = max(1, concurrency_state['limit'] // 2)
+                concurrency_state['last_decrease'] = now
+        else:
+            if concurrency_state['latency_baseline'] is None:
+                concurrency_state['latency_baseline'] = latency
+            latency_high = latency > concurrency_state['latency_baseline'] * ax_concurrency_latency_factor
+            concurrency_state['latency_baseline'] = concurrency_state['latency_baseline'] + ax_concurrency_latency_smoothing * (latency - concurrency_state['latency_baseline'])
+            if latency_high:
+                concurrency_state['window_successes'] = 0
+                if now - concurrency_state['last_decrease'] >= ax_concurrency_decrease_interval:
+                    concurrency_state['limit'] = max(1, concurrency_state['limit'] - 1)
+                    concurrency_state['last_decrease'] = now
+            else:
+                concurrency_state['window_successes'] = concurrency_state['window_successes'] + 1
+                if concurrency_state['window_successes'] >= concurrency_state['limit'] and concurrency_state['limit'] < concurrency_state['max_limit']:
+                    concurrency_state['limit'] = concurrency_state['limit'] + 1
+                    concurrency_state['peak_limit'] = max(concurrency_state['peak_limit'], concurrency_state['limit'])
+                    concurrency_state['window_successes'] = 0
+        concurrency_state['condition'].notify_all()
+
+# Run item_function for every item (device) with adaptive concurrency (up to max_workers), returning the results in item order
+# A failed item is reported and counted without stopping the others; the run exits with an error if any failed
+def ax_bulk_apply(item_list, item_function, max_workers):
+    concurrency_state = ax_concurrency_state
+    max_workers = max(1, max_workers)
+    concurrency_state.update({'limit': min(2, max_workers), 'max_limit': max_workers, 'peak_limit': min(2, max_workers), 'in_flight': 0,
+                              'window_successes': 0, 'latency_baseline': None, 'last_decrease': 0.0, 'throttled': 0})
+    # Keep a pooled connection for every worker (an HTTP/2 client multiplexes them over one connection instead)
+    if isinstance(ax_session, requests.Session):
+        ax_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=max_workers))
+    failed_items = []
+
+    def ax_bulk_apply_item(item):
+        with concurrency_state['condition']:
+            while concurrency_state['in_flight'] >= concurrency_state['limit']:
+                concurrency_state['condition'].wait()
+            concurrency_state['in_flight'] = concurrency_state['in_flight'] + 1
+        try:
+            return item_function(item)
+        except (Exception, SystemExit) as item_error:
+            print("Failed - " + str(item.get('display_name')) + " (Device ID " + str(item.get('id')) + "): " + repr(item_error))
+            failed_items.append(item)
+            return None
+        finally:
+            with concurrency_state['condition']:
+                concurrency_state['in_flight'] = concurrency_state['in_flight'] - 1
+                concurrency_state['condition'].notify_all()
+
+    bulk_start = time.perf_counter()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(ax_bulk_apply_item, item_list))
+    finally:
+        # Always report what was done, even if the run was interrupted
+        bulk_seconds = time.perf_counter() - bulk_start
+        print()
+        print("Bulk write summary: " + str(len(item_list)) + " calls in " + "{:.1f}".format(bulk_seconds) + "s (" + "{:.1f}".format(len(item_list) / max(bulk_seconds, 0.001)) + " calls/s)" +
+              ", " + str(len(failed_items)) + " failed")
+        print("Concurrency: final " + str(concurrency_state['limit']) + ", peak " + str(concurrency_state['peak_limit']) + ", max " + str(max_workers) +
+              ".  Throttled/5xx responses: " + str(concurrency_state['throttled']))
+    if failed_items:
+        ax_exit_error(500, str(len(failed_items)) + " of " + str(len(item_list)) + " device calls failed (listed above).")
+    return results
+
 # Main API Call Function
 def ax_call_api(action, api_url, ax_api_key, data=None, params=None, try_count=0, max_retries=2):
     retry_statuses = [429, 500, 502, 503, 504]
     retry_wait_timer = 5
     headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer ' + ax_api_key}
 
-    # Make the API Call
-    response = requests.request(action, api_url, params=params, headers=headers, data=json.dumps(data))
+    # Make the API Call (the httpx client used with -http2 takes a raw body as content)
+    request_start = time.perf_counter()
+    if isinstance(ax_session, requests.Session):
+        response = ax_session.request(action, api_url, params=params, headers=headers, data=json.dumps(data))
+    else:
+        response = ax_session.request(action, api_url, params=params, headers=headers, content=json.dumps(data))
+    ax_concurrency_record(response.status_code, time.perf_counter() - request_start)
 
     # Check for an error to retry, re-auth, or fail
     if response.status_code in retry_statuses:
@@ -33,17 +198,18 @@ def ax_call_api(action, api_url, ax_api_key, data=None, params=None, try_count=0
             return ax_call_api(action=action, api_url=api_url, ax_api_key=ax_api_key, data=data, params=params,
                                try_count=try_count, max_retries=max_retries)
         else:
-            if not response:
+            if response.status_code >= 400:
                 print(response.json())
             response.raise_for_status()
     else:
-        if not response:
+        if response.status_code >= 400:
                 print(response.json())
         response.raise_for_status()
 
     # Check for valid response and catch if blank or unexpected
     api_response_package = {}
     api_response_package['statusCode'] = response.status_code
+    decode_start = time.perf_counter()
     try:
         api_response_package['data'] = response.json()
     except ValueError:
@@ -51,6 +217,7 @@ def ax_call_api(action, api_url, ax_api_key, data=None, params=None, try_count=0
             api_response_package['data'] = None
         else:
             ax_exit_error(501, 'The server returned an unexpected server response.')
+    ax_profile_phase_add('decode', time.perf_counter() - decode_start)
     return api_response_package
 
 # Page wrapper for API Call
@@ -80,6 +247,14 @@ def ax_call_api_page(action, api_url, ax_api_key, data=None, params={}, max_retr
         else:
             return api_response_package
 
+# Get a single device (with details)
+def ax_device_get(ax_environment, ax_device_id):
+    url = "https://console.automox.com/api/servers/" + str(ax_device_id)
+    querystring = {"o":ax_environment['automox-org-id']}
+    action = "GET"
+    # Call the API
+    return ax_call_api(action, url, ax_environment['automox-api-key'], params=querystring)['data']
+
 # Get Devices list(with details)
 def ax_device_list_get(ax_environment):
     url = "https://console.automox.com/api/servers"
@@ -97,6 +272,102 @@ def ax_device_delete(ax_environment, ax_device_id):
     # Call the API
     return ax_call_api(action, url, ax_environment['automox-api-key'], params=querystring)
 
+# Pattern for the API timestamp format (optional fractional seconds and optional Z / +HH / +HHMM / +HH:MM offset)
+ax_timestamp_pattern = re.compile(r'^(\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2})(?:\.(\d+))?(Z|[+-]\d{2}(?::?\d{2})?)?$')
+
+# Parse an API timestamp into an aware UTC datetime (cached, as many devices share the same timestamps)
+@functools.lru_cache(maxsize=65536)
+def ax_timestamp_parse(timestamp):
+    timestamp_match = ax_timestamp_pattern.match(timestamp)
+    if not timestamp_match:
+        raise ValueError("Unexpected timestamp format: " + timestamp)
+    date_time, fraction, offset = timestamp_match.groups()
+    # Normalize to what fromisoformat accepts on every Python 3 version (6 digit fraction, +HH:MM offset)
+    if fraction:
+        date_time = date_time + "." + fraction[:6].ljust(6, "0")
+    if offset is None or offset == 'Z':
+        offset = "+00:00"
+    elif len(offset) == 3:
+        offset = offset + ":00"
+    elif ':' not in offset:
+        offset = offset[:3] + ":" + offset[3:]
+    return datetime.datetime.fromisoformat(date_time + offset).astimezone(datetime.timezone.utc)
+
+# Device snapshot layout: a header (magic, device count, time the snapshot was saved, offset of each column region),
+# then one region per column, all little-endian.  Numeric columns are fixed width arrays; string columns are
+# (device count + 1) offsets followed by the UTF-8 string data.  A script only reads and decodes the columns it asks
+# for - each of those is decoded in full when the snapshot is loaded.
+ax_snapshot_magic = b'AXSNAP02'
+ax_snapshot_numeric_columns = {'id': 'q', 'server_group_id': 'q', 'last_disconnect_time': 'd'}
+ax_snapshot_string_columns = ['display_name', 'name', 'tags', 'record']
+ax_snapshot_header = struct.Struct('<8sQd' + 'Q' * (len(ax_snapshot_numeric_columns) + len(ax_snapshot_string_columns)))
+ax_snapshot_tag_separator = '\x1f'
+
+# Read a single column from a memory mapped snapshot
+def ax_snapshot_column(snapshot_map, device_count, region_offset, column_name):
+    if column_name in ax_snapshot_numeric_columns:
+        column_values = struct.unpack_from('<' + str(device_count) + ax_snapshot_numeric_columns[column_name], snapshot_map, region_offset)
+        if column_name == 'last_disconnect_time':
+            column_values = [None if math.isnan(value) else datetime.datetime.fromtimestamp(value, datetime.timezone.utc).isoformat() for value in column_values]
+        return column_values
+
+    string_offsets = struct.unpack_from('<' + str(device_count + 1) + 'Q', snapshot_map, region_offset)
+    data_offset = region_offset + 8 * (device_count + 1)
+    column_values = [snapshot_map[data_offset + string_offsets[position]:data_offset + string_offsets[position + 1]].decode('utf-8')
+                     for position in range(device_count)]
+    if column_name == 'tags':
+        column_values = [value.split(ax_snapshot_tag_separator) if value else [] for value in column_values]
+    return column_values
+
+# Load a device list from a snapshot file, only reading the columns asked for.  With max_age_minutes, refuse a
+# snapshot saved longer ago than that.
+def ax_snapshot_device_list(snapshot_file, column_names, max_age_minutes=None):
+    with open(snapshot_file, mode='rb') as snapshot_handle:
+        snapshot_size = os.fstat(snapshot_handle.fileno()).st_size
+        snapshot_map = mmap.mmap(snapshot_handle.fileno(), 0, access=mmap.ACCESS_READ) if snapshot_size else b''
+    if snapshot_size < ax_snapshot_header.size or snapshot_map[:len(ax_snapshot_magic)] != ax_snapshot_magic:
+        ax_exit_error(400, snapshot_file + " is not a device snapshot file (or was saved by an older version of ax-device-list-with-query.py).")
+    header_values = ax_snapshot_header.unpack_from(snapshot_map, 0)
+    device_count = header_values[1]
+    saved_time = datetime.datetime.fromtimestamp(header_values[2], datetime.timezone.utc)
+    region_offsets = dict(zip(list(ax_snapshot_numeric_columns) + ax_snapshot_string_columns, header_values[3:]))
+
+    snapshot_age = datetime.datetime.now(datetime.timezone.utc) - saved_time
+    print("Snapshot saved at " + str(saved_time) + " (" + str(int(snapshot_age.total_seconds() // 60)) + " minutes ago).")
+    if max_age_minutes is not None and snapshot_age > datetime.timedelta(minutes=max_age_minutes):
+        ax_exit_error(400, snapshot_file + " is older than " + str(max_age_minutes) + " minutes.  Save a new snapshot, or raise -snapshot_max_age to use it anyway.")
+
+    device_list = [{} for position in range(device_count)]
+    for column_name in column_names:
+        column_values = ax_snapshot_column(snapshot_map, device_count, region_offsets[column_name], column_name)
+        for device, value in zip(device_list, column_values):
+            device[column_name] = value
+    return device_list
+
+# Check whether a device's agent is connected right now (the record's connected flag, or its agent status)
+def ax_device_connected(device):
+    if device.get('connected'):
+        return True
+    return (device.get('status') or {}).get('agent_status') == 'connected'
+
+# Check that a freshly fetched device is still disconnected, and has been since before the cutoff
+def ax_device_disconnected_since(device, cutoff_time):
+    if not device or ax_device_connected(device) or device.get('last_disconnect_time') is None:
+        return False
+    try:
+        return ax_timestamp_parse(device['last_disconnect_time']) < cutoff_time
+    except ValueError:
+        return False
+
+# Remove one device (run by ax_bulk_apply).  With cutoff_time, the device's current record is checked first
+def ax_device_remove_apply(ax_environment, cutoff_time, device):
+    # Snapshot runs pass a cutoff, as the device may have reconnected since the snapshot was saved
+    if cutoff_time is not None and not ax_device_disconnected_since(ax_device_get(ax_environment, device['id']), cutoff_time):
+        print("Device " + str(device['name']) + " with Device ID " + str(device['id']) + " is connected again or was disconnected too recently - skipping.")
+        return None
+    response = ax_device_delete(ax_environment, device['id'])
+    print("removing device from Automox console: " + device['display_name'] + "\n" + str(response))
+    return response
 
 # --Execution Block-- #
 # --Parse command line arguments-- #
@@ -118,6 +389,33 @@ parser.add_argument(
     default=10,
     help='(Optional) - Time in minutes the client should be disconnected for, at minimum.')
 
+parser.add_argument(
+    '-snapshot',
+    type=str,
+    help='(Optional) Load the device list from a snapshot file (written by ax-device-list-with-query.py -snapshot_save) instead of calling the API.  Each device is fetched again and checked before it is removed.')
+
+parser.add_argument(
+    '-snapshot_max_age',
+    type=int,
+    default=15,
+    help='(Optional - Default to 15)  Refuse a -snapshot saved more than this many minutes ago, since this run changes devices based on it.')
+
+parser.add_argument(
+    '-max_workers',
+    type=int,
+    default=8,
+    help='(Optional - Default to 8)  Most delete calls to run at once.  Concurrency starts low and adapts to API latency and throttling (1 = one at a time).')
+
+parser.add_argument(
+    '-http2',
+    action='store_true',
+    help='(Optional-Flag) Send the API calls over HTTP/2 (needs httpx: pip install httpx[http2]).  Concurrent bulk writes then share one multiplexed connection instead of one connection per worker.  Compare the two with ax-bulk-http2-benchmark.py.')
+
+parser.add_argument(
+    '-profile',
+    type=str,
+    help='(Optional) Profile the run with cProfile and write the stats to this file (phase timing summary goes to <file>.txt).  Bulk writes run on worker threads that cProfile does not follow, so the apply phase shows in the phase timing (wall time) but not in the function stats.')
+
 args = parser.parse_args()
 # --End parse command line arguments-- #
 
@@ -128,26 +426,30 @@ ax_environment = {}
 ax_environment['automox-org-id'] = args.ax_org_id
 ax_environment['automox-api-key'] = args.ax_api_key
 
+if args.profile:
+    ax_profile_start(args.profile)
+if args.http2:
+    ax_session_http2()
+
 current_datetime = datetime.datetime.now()
 print("Current date and time:", current_datetime)
 
-response_data = ax_device_list_get(ax_environment)
-
-# Create a temp working list
-working_names = []
-
-# Create a list of the names from the dicts
-for device in response_data:
-    working_names.append(device["display_name"])
+ax_profile_phase('fetch')
+if args.snapshot:
+    print("Loading the device list from snapshot " + args.snapshot + "...")
+    response_data = ax_snapshot_device_list(args.snapshot, ['id', 'display_name', 'name', 'last_disconnect_time'], args.snapshot_max_age)
+else:
+    print("Calling the API to get the device list...")
+    response_data = ax_device_list_get(ax_environment)
 
-# Now Find dup names
-duplicate_names = set([x for x in working_names if working_names.count(x) > 1])
+ax_profile_phase('plan')
 
-# Convert the set into a list
-duplicate_names = list(duplicate_names)
+# Count the names in one pass and find dup names
+name_counts = collections.Counter(device["display_name"] for device in response_data)
+duplicate_names = set(name for name, name_count in name_counts.items() if name_count > 1)
 
-# Get delta minutes calc
-cutoff_time = datetime.datetime.utcnow() - datetime.timedelta(minutes=args.mintuesDisconnectFor)
+# Get delta minutes calc (aware UTC, so offsets in the API timestamps are honored)
+cutoff_time = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=args.mintuesDisconnectFor)
 
 # Create list to be deleted
 devices_to_remove = []
@@ -156,7 +458,11 @@ devices_to_remove = []
 for device in response_data:
     if device['last_disconnect_time'] is not None:
         if device['display_name'] in duplicate_names:
-            last_disconnect_time = datetime.datetime.strptime(device['last_disconnect_time'].split("+")[0], "%Y-%m-%dT%H:%M:%S")
+            try:
+                last_disconnect_time = ax_timestamp_parse(device['last_disconnect_time'])
+            except ValueError as timestamp_error:
+                print("Warning - device " + str(device['name']) + " with Device ID " + str(device['id']) + " has a last disconnect time that can't be read (" + str(timestamp_error) + ").  Skipping device.")
+                continue
 
             # If device has been disconnected before the cutoff date, include it in the list
             if last_disconnect_time < cutoff_time:
@@ -164,10 +470,8 @@ for device in response_data:
                 devices_to_remove.append(device)
 
 # Remove the devices
+ax_profile_phase('apply')
 if len(devices_to_remove) > 0:
-    for device in devices_to_remove:
-        print("removing device from Automox console: "+ device['display_name'])
-        response = ax_device_delete(ax_environment, device['id'])
-        print(response)
+    ax_bulk_apply(devices_to_remove, functools.partial(ax_device_remove_apply, ax_environment, cutoff_time if args.snapshot else None), args.max_workers)
 else:
     print("Nothing to remove!")
\ No newline at end of file
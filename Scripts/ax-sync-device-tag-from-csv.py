@@ -1,14 +1,26 @@
 ### Example script to set a tag (Owner in this case) on devices based on an ingested CSV file
+import datetime
+import functools
 import requests
+import concurrent.futures
+import threading
 import argparse
+import atexit
 import time
+import struct
+import mmap
 import json
+import math
 import sys
+import zlib
 import csv
 import os
 
 # --Function Block--#
 
+# Shared HTTP session so every API call reuses pooled keep-alive connections (and TLS sessions)
+ax_session = requests.Session()
+
 # Exit handler (Error)
 def ax_exit_error(error_code, error_message=None, system_message=None):
     print(error_code)
@@ -18,14 +30,166 @@ def ax_exit_error(error_code, error_message=None, system_message=None):
         print(system_message)
     sys.exit(1)
 
+# Switch the shared session to an HTTP/2 client (httpx) for -http2, so concurrent bulk writes are multiplexed over one
+# connection (and one TLS session) instead of one HTTP/1.1 connection per worker.  httpx is only needed with -http2
+def ax_session_http2():
+    global ax_session
+    try:
+        import httpx
+        # No timeout and follow redirects, the same as the requests session
+        ax_session = httpx.Client(http2=True, follow_redirects=True, timeout=None)
+    except ImportError as import_error:
+        ax_exit_error(400, "-http2 needs httpx with HTTP/2 support.  Install it with: pip install httpx[http2]", str(import_error))
+
+# Profiling state, only populated when the run is started with -profile
+ax_profile_state = {'profiler': None, 'profile_file': None, 'phase': None, 'phase_start': None, 'phase_times': {}}
+
+# Start profiling the run and write the report when the script exits (including error exits)
+def ax_profile_start(profile_file):
+    # Imported here so runs without -profile don't pay for loading the profiler
+    import cProfile
+    ax_profile_state['profile_file'] = profile_file
+    ax_profile_state['profiler'] = cProfile.Profile()
+    atexit.register(ax_profile_stop)
+    ax_profile_state['profiler'].enable()
+
+# Mark the start of a run phase (fetch, plan, apply, etc.), closing the previous one
+def ax_profile_phase(phase_name):
+    if ax_profile_state['profiler'] is None:
+        return
+    now = time.perf_counter()
+    if ax_profile_state['phase'] is not None:
+        ax_profile_phase_add(ax_profile_state['phase'], now - ax_profile_state['phase_start'])
+    ax_profile_state['phase'] = phase_name
+    ax_profile_state['phase_start'] = now
+
+# Add time to a phase directly (used for decode time, which is nested inside other phases)
+def ax_profile_phase_add(phase_name, seconds):
+    if ax_profile_state['profiler'] is None:
+        return
+    phase_times = ax_profile_state['phase_times']
+    phase_times[phase_name] = phase_times.get(phase_name, 0.0) + seconds
+
+# Stop profiling, write the profile file and the phase timing summary
+def ax_profile_stop():
+    # Imported here so runs without -profile don't pay for loading pstats
+    import pstats
+    profiler = ax_profile_state['profiler']
+    if profiler is None:
+        return
+    profiler.disable()
+    ax_profile_phase(None)
+    ax_profile_state['profiler'] = None
+    profile_file = ax_profile_state['profile_file']
+    profiler.dump_stats(profile_file)
+
+    summary_lines = ["Phase timing summary (seconds, decode is included in the phase that made the call):"]
+    for phase_name, seconds in ax_profile_state['phase_times'].items():
+        summary_lines.append("  {:<10} {:>10.3f}".format(phase_name, seconds))
+    print()
+    print("\n".join(summary_lines))
+    print("Profile written to " + profile_file + " (phase summary and top functions in " + profile_file + ".txt)")
+    with open(profile_file + ".txt", mode='w') as summary_file:
+        summary_file.write("\n".join(summary_lines) + "\n\n")
+        pstats.Stats(profiler, stream=summary_file).sort_stats('cumulative').print_stats(25)
+
+# Adaptive (AIMD) concurrency for bulk writes: the in-flight limit grows by one after a full window of fast, clean
+# calls, drops by one when latency climbs past twice a smoothed (EWMA) baseline, and halves on 429/5xx responses.
+# The baseline follows the API's latency as it drifts, so one unusually fast early call doesn't pin it for the whole run
+ax_concurrency_state = {'limit': 1, 'max_limit': 1, 'peak_limit': 1, 'in_flight': 0, 'window_successes': 0,
+                        'latency_baseline': None, 'last_decrease': 0.0, 'throttled': 0, 'condition': threading.Condition()}
+ax_concurrency_throttle_statuses = [429, 500, 502, 503, 504]
+ax_concurrency_latency_factor = 2.0
+ax_concurrency_latency_smoothing = 0.1
+ax_concurrency_decrease_interval = 1.0
+
+# Record the outcome of one API call attempt and adjust the in-flight limit
+def ax_concurrency_record(status_code, latency):
+    concurrency_state = ax_concurrency_state
+    with concurrency_state['condition']:
+        now = time.monotonic()
+        if status_code in ax_concurrency_throttle_statuses:
+            concurrency_state['throttled'] = concurrency_state['throttled'] + 1
+            concurrency_state['window_successes'] = 0
+            # Calls already in flight report the same overload, so only back off once per interval
+            if now - concurrency_state['last_decrease'] >= ax_concurrency_decrease_interval:
+                concurrency_state['limit'] = max(1, concurrency_state['limit'] // 2)
+                concurrency_state['last_decrease'] = now
+        else:
+            if concurrency_state['latency_baseline'] is None:
+                concurrency_state['latency_baseline'] = latency
+            latency_high = latency > concurrency_state['latency_baseline'] * ax_concurrency_latency_factor
+            concurrency_state['latency_baseline'] = concurrency_state['latency_baseline'] + ax_concurrency_latency_smoothing * (latency - concurrency_state['latency_baseline'])
+            if latency_high:
+                concurrency_state['window_successes'] = 0
+                if now - concurrency_state['last_decrease'] >= ax_concurrency_decrease_interval:
+                    concurrency_state['limit'] = max(1, concurrency_state['limit'] - 1)
+                    concurrency_state['last_decrease'] = now
+            else:
+                concurrency_state['window_successes'] = concurrency_state['window_successes'] + 1
+                if concurrency_state['window_successes'] >= concurrency_state['limit'] and concurrency_state['limit'] < concurrency_state['max_limit']:
+                    concurrency_state['limit'] = concurrency_state['limit'] + 1
+                    concurrency_state['peak_limit'] = max(concurrency_state['peak_limit'], concurrency_state['limit'])
+                    concurrency_state['window_successes'] = 0
+        concurrency_state['condition'].notify_all()
+
+# Run item_function for every item (device) with adaptive concurrency (up to max_workers), returning the results in item order
+# A failed item is reported and counted without stopping the others; the run exits with an error if any failed
+def ax_bulk_apply(item_list, item_function, max_workers):
+    concurrency_state = ax_concurrency_state
+    max_workers = max(1, max_workers)
+    concurrency_state.update({'limit': min(2, max_workers), 'max_limit': max_workers, 'peak_limit': min(2, max_workers), 'in_flight': 0,
+                              'window_successes': 0, 'latency_baseline': None, 'last_decrease': 0.0, 'throttled': 0})
+    # Keep a pooled connection for every worker (an HTTP/2 client multiplexes them over one connection instead)
+    if isinstance(ax_session, requests.Session):
+        ax_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=max_workers))
+    failed_items = []
+
+    def ax_bulk_apply_item(item):
+        with concurrency_state['condition']:
+            while concurrency_state['in_flight'] >= concurrency_state['limit']:
+                concurrency_state['condition'].wait()
+            concurrency_state['in_flight'] = concurrency_state['in_flight'] + 1
+        try:
+            return item_function(item)
+        except (Exception, SystemExit) as item_error:
+            print("Failed - " + str(item.get('display_name')) + " (Device ID " + str(item.get('id')) + "): " + repr(item_error))
+            failed_items.append(item)
+            return None
+        finally:
+            with concurrency_state['condition']:
+                concurrency_state['in_flight'] = concurrency_state['in_flight'] - 1
+                concurrency_state['condition'].notify_all()
+
+    bulk_start = time.perf_counter()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(ax_bulk_apply_item, item_list))
+    finally:
+        # Always report what was done, even if the run was interrupted
+        bulk_seconds = time.perf_counter() - bulk_start
+        print()
+        print("Bulk write summary: " + str(len(item_list)) + " calls in " + "{:.1f}".format(bulk_seconds) + "s (" + "{:.1f}".format(len(item_list) / max(bulk_seconds, 0.001)) + " calls/s)" +
+              ", " + str(len(failed_items)) + " failed")
+        print("Concurrency: final " + str(concurrency_state['limit']) + ", peak " + str(concurrency_state['peak_limit']) + ", max " + str(max_workers) +
+              ".  Throttled/5xx responses: " + str(concurrency_state['throttled']))
+    if failed_items:
+        ax_exit_error(500, str(len(failed_items)) + " of " + str(len(item_list)) + " device calls failed (listed above).")
+    return results
+
 # Main API Call Function
 def ax_call_api(action, api_url, ax_api_key, data=None, params=None, try_count=0, max_retries=2):
     retry_statuses = [429, 500, 502, 503, 504]
     retry_wait_timer = 5
     headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer ' + ax_api_key}
 
-    # Make the API Call
-    response = requests.request(action, api_url, params=params, headers=headers, data=json.dumps(data))
+    # Make the API Call (the httpx client used with -http2 takes a raw body as content)
+    request_start = time.perf_counter()
+    if isinstance(ax_session, requests.Session):
+        response = ax_session.request(action, api_url, params=params, headers=headers, data=json.dumps(data))
+    else:
+        response = ax_session.request(action, api_url, params=params, headers=headers, content=json.dumps(data))
+    ax_concurrency_record(response.status_code, time.perf_counter() - request_start)
 
     # Check for an error to retry, re-auth, or fail
     if response.status_code in retry_statuses:
@@ -35,17 +199,18 @@ def ax_call_api(action, api_url, ax_api_key, data=None, params=None, try_count=0
             return ax_call_api(action=action, api_url=api_url, ax_api_key=ax_api_key, data=data, params=params,
                                try_count=try_count, max_retries=max_retries)
         else:
-            if not response:
+            if response.status_code >= 400:
                 print(response.json())
             response.raise_for_status()
     else:
-        if not response:
+        if response.status_code >= 400:
                 print(response.json())
         response.raise_for_status()
 
     # Check for valid response and catch if blank or unexpected
     api_response_package = {}
     api_response_package['statusCode'] = response.status_code
+    decode_start = time.perf_counter()
     try:
         api_response_package['data'] = response.json()
     except ValueError:
@@ -53,6 +218,7 @@ def ax_call_api(action, api_url, ax_api_key, data=None, params=None, try_count=0
             api_response_package['data'] = None
         else:
             ax_exit_error(501, 'The server returned an unexpected server response.')
+    ax_profile_phase_add('decode', time.perf_counter() - decode_start)
     return api_response_package
 
 # Page wrapper for API Call
@@ -81,6 +247,14 @@ def ax_call_api_page(action, api_url, ax_api_key, data=None, params={}, max_retr
         else:
             return api_response_package
 
+# Get a single device (with details)
+def ax_device_get(ax_environment, ax_device_id):
+    url = "https://console.automox.com/api/servers/" + str(ax_device_id)
+    querystring = {"o":ax_environment['automox-org-id']}
+    action = "GET"
+    # Call the API
+    return ax_call_api(action, url, ax_environment['automox-api-key'], params=querystring)['data']
+
 # Get Devices list(with details)
 def ax_device_list_get(ax_environment):
     url = "https://console.automox.com/api/servers"
@@ -146,123 +320,226 @@ def duplicate_check(object_list):
             object_set.add(single_object)         
     return None
 
-# --Execution Block-- #
-# --Parse command line arguments-- #
-parser = argparse.ArgumentParser()
-
-parser.add_argument(
-    'ax_org_id',
-    type=str,
-    help='Automox Org ID.')
-
-parser.add_argument(
-    'ax_api_key',
-    type=str,
-    help='Automox API Key.')
-
-parser.add_argument(
-    'csv_file',
-    type=str,
-    help='File name (and path, if needed) for the CSV file to sync groups for.')
-
-parser.add_argument(
-    '-csv_column_hostname_position',
-    type=int,
-    default=0,
-    help='(Optional - Default to 0)  Column positon in CSV that contains the hostname to compare.')
-
-parser.add_argument(
-    '-csv_column_owner_position',
-    type=int,
-    default=1,
-    help='(Optional - Default to 1)  Column positon in CSV that contains the owner information.')
-
-parser.add_argument(
-    '-tag_header',
-    type=str,
-    default='Owner-',
-    help='(Optional - Default to "Owner-")  Header for the added tag.')
-
-args = parser.parse_args()
-# --End parse command line arguments-- #
-
-# --Main-- #
-
-# Create environment dict & vars
-ax_environment = {}
-ax_environment['automox-org-id'] = args.ax_org_id
-ax_environment['automox-api-key'] = args.ax_api_key
-csv_column_hostname_position = args.csv_column_hostname_position
-csv_column_owner_position = args.csv_column_owner_position
-csv_file = args.csv_file
-tag_header = args.tag_header
-
-print()
-print("Loading the CSV...")
-csv_list = ax_file_load_csv_list(csv_file)
-
-print("Checking for any rows with extra or not enough data...")
-row_count = 0
-csv_list_new = []
-for row in csv_list:
-    row_count = row_count + 1
-    if len(row) != 0:
-        if len(row) != 2:
-            if len(row) > 2:
-                print("Found a row with more than 2 data objects - skipping row:")
-                print("Row #: " + str(row_count))
-                print("Row data: ")
-                print(row)
-                print()
-            else:
-                print("Found a row with less than 2 data objects - skipping row:")
-                print("Row #: " + str(row_count))
-                print("Row data: ")
-                print(row)
-                print()
-        else:
-            csv_list_new.append(row)
-if len(csv_list_new) == 0:
-    ax_exit_error(400, "No valid rows found in the CSV.  Exiting!")
-else:
-    csv_list = csv_list_new
-
-# Converting the import into a dict format to make things easier to find and expand on in the future
-csv_list_dict = []
-duplicate_names_test_list = []
-for row in csv_list:
-    row_dict = {}
-    row_dict['display_name'] = row[csv_column_hostname_position]
-    row_dict['owner'] = row[csv_column_owner_position]
-    row_dict['owner_tag'] = tag_header + row_dict['owner']
-    # Create a lower case version of the hostname for later tests
-    row_dict['display_name_lower'] = row_dict['display_name'].lower()
-    # Add hostname to a list for testing for duplicates
-    duplicate_names_test_list.append(row_dict['display_name_lower'])
-    # Add the new dict to the new list for import
-    csv_list_dict.append(row_dict)
-
-print("Checking for any duplicate host names from the CSV import list...")
-duplicate_found = duplicate_check(duplicate_names_test_list)
-if duplicate_found:
-    print("Found duplicate host name in the CSV import list:" + str(duplicate_found))
-    ax_exit_error(400)
-
-print("Calling the API to get the device list...")
-device_list = ax_device_list_get(ax_environment)
-
-print("Adding 1 pass lower case to make searching loop more efficent later...")
-for device in device_list:
-    device['display_name_lower'] = device['display_name'].lower()
-
-print("Matching device changes based on CSV values...")
-devices_to_update = []
-for csv_device in csv_list_dict:
-    found = False
-    tag_exists = False
+# Normalize a hostname for matching (trim, case fold, drop trailing dot and the domain part of an FQDN)
+# Matches on it are only kept when the domains agree (see ax_hostname_domains_agree)
+def ax_hostname_normalize(hostname):
+    hostname = hostname.strip().casefold().rstrip('.')
+    hostname_parts = hostname.split('.')
+    # Leave IP addresses whole
+    if all(hostname_part.isdigit() for hostname_part in hostname_parts):
+        return hostname
+    return hostname_parts[0]
+
+# Get the domain part of a hostname ('' for a short name or an IP address)
+def ax_hostname_domain(hostname):
+    hostname = hostname.strip().casefold().rstrip('.')
+    hostname_parts = hostname.split('.')
+    if all(hostname_part.isdigit() for hostname_part in hostname_parts):
+        return ''
+    return '.'.join(hostname_parts[1:])
+
+# Check two hostname domains can belong to the same host - a short name fits any domain, otherwise one domain has
+# to be the other or the start of it (ex. 'prod' and 'prod.example.com'), so web01.prod and web01.dev never match
+def ax_hostname_domains_agree(domain, other_domain):
+    if not domain or not other_domain or domain == other_domain:
+        return True
+    return domain.startswith(other_domain + '.') or other_domain.startswith(domain + '.')
+
+# Split a normalized hostname into its set of trigrams (padded so short names still have some)
+def ax_hostname_trigrams(hostname):
+    padded_hostname = "  " + hostname + " "
+    return set(padded_hostname[position:position + 3] for position in range(len(padded_hostname) - 2))
+
+# Build the hostname matching index for a device list (exact, normalized and, if asked for, trigram lookups)
+def ax_hostname_index_build(device_list, fuzzy=False):
+    hostname_index = {'exact': {}, 'normalized': {}, 'trigrams': None, 'trigram_sets': None}
     for device in device_list:
-        if device['display_name_lower'] == csv_device['display_name_lower']:
-            found = True
+        hostname_index['exact'].setdefault(device['display_name'].lower(), []).append(device)
+        hostname_index['normalized'].setdefault(ax_hostname_normalize(device['display_name']), []).append(device)
+    if fuzzy:
+        hostname_index['trigrams'] = {}
+        hostname_index['trigram_sets'] = {}
+        for normalized_name in hostname_index['normalized']:
+            name_trigrams = ax_hostname_trigrams(normalized_name)
+            hostname_index['trigram_sets'][normalized_name] = name_trigrams
+            for trigram in name_trigrams:
+                hostname_index['trigrams'].setdefault(trigram, []).append(normalized_name)
+    return hostname_index
+
+# Similarity margin a fuzzy match has to win by - anything scoring within it of the best name counts as a tie
+ax_hostname_fuzzy_margin = 0.05
+
+# Find the device(s) for a hostname - exact (case insensitive) first, then normalized, then trigram similarity
+# Returns the match type ('exact', 'normalized', 'fuzzy', 'ambiguous' or None) and the matched devices
+def ax_hostname_index_match(hostname_index, hostname, fuzzy_threshold=None):
+    matched_devices = hostname_index['exact'].get(hostname.lower())
+    if matched_devices:
+        return 'exact', matched_devices
+
+    normalized_name = ax_hostname_normalize(hostname)
+    hostname_domain = ax_hostname_domain(hostname)
+    matched_devices = [device for device in hostname_index['normalized'].get(normalized_name, [])
+                       if ax_hostname_domains_agree(hostname_domain, ax_hostname_domain(device['display_name']))]
+    if matched_devices:
+        # Same short name on different FQDNs can't be told apart
+        if len(set(device['display_name'].lower() for device in matched_devices)) > 1:
+            return 'ambiguous', matched_devices
+        return 'normalized', matched_devices
+
+    if fuzzy_threshold is None or hostname_index['trigrams'] is None:
+        return None, []
+
+    # A name needs at least min_shared trigrams in common to reach a score, so candidates only have to be collected
+    # from the rarest (count - min_shared + 1) trigrams - the common ones ('  w', 'web', ...) are skipped
+    name_trigrams = ax_hostname_trigrams(normalized_name)
+    rare_trigrams = sorted(name_trigrams, key=lambda trigram: len(hostname_index['trigrams'].get(trigram, ())))
+    candidate_scores = {}
+    collected_count = 0
+
+    # Score the candidates with the Dice coefficient - first those that can reach the threshold, then (once the best
+    # score is known) any others that can land within the margin of it
+    for min_score in (fuzzy_threshold, None):
+        if min_score is None:
+            best_score = max(candidate_scores.values(), default=0.0)
+            if best_score < fuzzy_threshold:
+                return None, []
+            min_score = max(best_score - ax_hostname_fuzzy_margin, 0.0)
+        min_shared = math.ceil(min_score * len(name_trigrams) / (2.0 - min_score))
+        for trigram in rare_trigrams[collected_count:len(name_trigrams) - min_shared + 1]:
+            for candidate_name in hostname_index['trigrams'].get(trigram, ()):
+                if candidate_name not in candidate_scores:
+                    candidate_trigrams = hostname_index['trigram_sets'][candidate_name]
+                    candidate_scores[candidate_name] = 2.0 * len(name_trigrams & candidate_trigrams) / (len(name_trigrams) + len(candidate_trigrams))
+        collected_count = max(collected_count, len(name_trigrams) - min_shared + 1)
+    best_names = [candidate_name for candidate_name, score in candidate_scores.items() if score > best_score - ax_hostname_fuzzy_margin]
+    matched_devices = []
+    for best_name in best_names:
+        matched_devices.extend(device for device in hostname_index['normalized'][best_name]
+                               if ax_hostname_domains_agree(hostname_domain, ax_hostname_domain(device['display_name'])))
+    if not matched_devices:
+        return None, []
+    if len(set(device['display_name'].lower() for device in matched_devices)) > 1:
+        return 'ambiguous', matched_devices
+    return 'fuzzy', matched_devices
+
+# Find the CSV rows that resolve to the same device as another row (ex. host01 and host01.corp.com)
+# Takes the hostname and matched device ids of each row, returns {row position: hostnames of the other rows}
+def ax_hostname_row_conflicts(hostnames, row_device_ids):
+    device_rows = {}
+    for row_position, device_ids in enumerate(row_device_ids):
+        for device_id in device_ids:
+            device_rows.setdefault(device_id, set()).add(row_position)
+    row_conflicts = {}
+    for row_positions in device_rows.values():
+        if len(row_positions) > 1:
+            for row_position in row_positions:
+                row_conflicts.setdefault(row_position, set()).update(row_positions - {row_position})
+    return {row_position: sorted(hostnames[other_position] for other_position in other_positions) for row_position, other_positions in row_conflicts.items()}
+
+# Build the warning or note for a CSV hostname that wasn't an exact match (None for an exact match)
+# Fuzzy matches are only suggestions unless fuzzy_apply is set
+def ax_hostname_match_message(hostname, source_name, match_type, matched_devices, fuzzy_apply=False):
+    if match_type is None:
+        return "Warning - device from " + source_name + " " + hostname + " not found in Automox!  Skipping device."
+    if match_type == 'ambiguous':
+        return "Warning - device from " + source_name + " " + hostname + " matches more than one device (" + ", ".join(sorted(set(device['display_name'] for device in matched_devices))) + ")!  Skipping device."
+    if match_type == 'fuzzy' and not fuzzy_apply:
+        return "Suggestion - device from " + source_name + " " + hostname + " not found in Automox, closest match is " + matched_devices[0]['display_name'] + ".  Use -fuzzy_match_apply to apply fuzzy matches.  Skipping device."
+    if match_type != 'exact':
+        return "Note - device from " + source_name + " " + hostname + " matched device " + matched_devices[0]['display_name'] + " by " + match_type + " name."
+    return None
+
+# Device snapshot layout: a header (magic, device count, time the snapshot was saved, offset of each column region),
+# then one region per column, all little-endian.  Numeric columns are fixed width arrays; string columns are
+# (device count + 1) offsets followed by the UTF-8 string data.  A script only reads and decodes the columns it asks
+# for - each of those is decoded in full when the snapshot is loaded.
+ax_snapshot_magic = b'AXSNAP02'
+ax_snapshot_numeric_columns = {'id': 'q', 'server_group_id': 'q', 'last_disconnect_time': 'd'}
+ax_snapshot_string_columns = ['display_name', 'name', 'tags', 'record']
+ax_snapshot_header = struct.Struct('<8sQd' + 'Q' * (len(ax_snapshot_numeric_columns) + len(ax_snapshot_string_columns)))
+ax_snapshot_tag_separator = '\x1f'
+
+# Read a single column from a memory mapped snapshot
+def ax_snapshot_column(snapshot_map, device_count, region_offset, column_name):
+    if column_name in ax_snapshot_numeric_columns:
+        column_values = struct.unpack_from('<' + str(device_count) + ax_snapshot_numeric_columns[column_name], snapshot_map, region_offset)
+        if column_name == 'last_disconnect_time':
+            column_values = [None if math.isnan(value) else datetime.datetime.fromtimestamp(value, datetime.timezone.utc).isoformat() for value in column_values]
+        return column_values
+
+    string_offsets = struct.unpack_from('<' + str(device_count + 1) + 'Q', snapshot_map, region_offset)
+    data_offset = region_offset + 8 * (device_count + 1)
+    column_values = [snapshot_map[data_offset + string_offsets[position]:data_offset + string_offsets[position + 1]].decode('utf-8')
+                     for position in range(device_count)]
+    if column_name == 'tags':
+        column_values = [value.split(ax_snapshot_tag_separator) if value else [] for value in column_values]
+    return column_values
+
+# Load a device list from a snapshot file, only reading the columns asked for.  With max_age_minutes, refuse a
+# snapshot saved longer ago than that.
+def ax_snapshot_device_list(snapshot_file, column_names, max_age_minutes=None):
+    with open(snapshot_file, mode='rb') as snapshot_handle:
+        snapshot_size = os.fstat(snapshot_handle.fileno()).st_size
+        snapshot_map = mmap.mmap(snapshot_handle.fileno(), 0, access=mmap.ACCESS_READ) if snapshot_size else b''
+    if snapshot_size < ax_snapshot_header.size or snapshot_map[:len(ax_snapshot_magic)] != ax_snapshot_magic:
+        ax_exit_error(400, snapshot_file + " is not a device snapshot file (or was saved by an older version of ax-device-list-with-query.py).")
+    header_values = ax_snapshot_header.unpack_from(snapshot_map, 0)
+    device_count = header_values[1]
+    saved_time = datetime.datetime.fromtimestamp(header_values[2], datetime.timezone.utc)
+    region_offsets = dict(zip(list(ax_snapshot_numeric_columns) + ax_snapshot_string_columns, header_values[3:]))
+
+    snapshot_age = datetime.datetime.now(datetime.timezone.utc) - saved_time
+    print("Snapshot saved at " + str(saved_time) + " (" + str(int(snapshot_age.total_seconds() // 60)) + " minutes ago).")
+    if max_age_minutes is not None and snapshot_age > datetime.timedelta(minutes=max_age_minutes):
+        ax_exit_error(400, snapshot_file + " is older than " + str(max_age_minutes) + " minutes.  Save a new snapshot, or raise -snapshot_max_age to use it anyway.")
+
+    device_list = [{} for position in range(device_count)]
+    for column_name in column_names:
+        column_values = ax_snapshot_column(snapshot_map, device_count, region_offsets[column_name], column_name)
+        for device, value in zip(device_list, column_values):
+            device[column_name] = value
+    return device_list
+
+# Re-plan a device update against the device's current record (for plans made from a snapshot, which can be minutes old)
+# Keeps the planned owner tag and group and takes everything else from the current record; None if nothing is left to change
+def ax_device_update_refresh(planned_device, current_device):
+    refreshed_device = {}
+    refreshed_device['display_name'] = current_device['display_name']
+    refreshed_device['id'] = current_device['id']
+    refreshed_device['server_group_id'] = planned_device.get('planned_server_group_id', current_device['server_group_id'])
+    if 'owner_tag' in planned_device and planned_device['owner_tag'] not in current_device['tags']:
+        refreshed_device['tags'] = [tag for tag in current_device['tags'] if not tag.startswith(planned_device['tag_header'])] + [planned_device['owner_tag']]
+    if 'tags' not in refreshed_device and refreshed_device['server_group_id'] == current_device['server_group_id']:
+        return None
+    return refreshed_device
+
+# Send one planned device update (run by ax_bulk_apply).  With refetch, the update is first re-planned from the device's current record
+def ax_device_update_apply(ax_environment, refetch, updated_device):
+    if refetch:
+        refreshed_device = ax_device_update_refresh(updated_device, ax_device_get(ax_environment, updated_device['id']))
+        if refreshed_device is None:
+            print("Device " + updated_device['display_name'] + " already has the planned changes - skipping.")
+            return None
+        updated_device = refreshed_device
+    print("Updating device " + updated_device['display_name'])
+    return ax_device_put(ax_environment, updated_device['id'], tags=updated_device.get('tags'), server_group_id=updated_device['server_group_id'])
+
+# Plan the tag changes for (row position, CSV row dict) pairs against a device list
+# Returns (row position, found, matched device ids, messages, updated devices) per row, so shards can be merged back in CSV order
+def ax_tag_plan(csv_rows, device_list, tag_header, fuzzy_match_threshold, fuzzy_match_apply=False):
+    hostname_index = ax_hostname_index_build(device_list, fuzzy=fuzzy_match_threshold is not None)
+    row_plans = []
+    for row_position, csv_device in csv_rows:
+        messages = []
+        updated_devices = []
+        match_type, matched_devices = ax_hostname_index_match(hostname_index, csv_device['display_name'], fuzzy_match_threshold)
+        match_message = ax_hostname_match_message(csv_device['display_name'], "CSV", match_type, matched_devices, fuzzy_match_apply)
+        if match_message is not None:
+            messages.append(match_message)
+        if match_type == 'ambiguous' or (match_type == 'fuzzy' and not fuzzy_match_apply):
+            matched_devices = []
+        for device in matched_devices:
+            tag_exists = False
             tags_new = []
             if len(device['tags']) > 0:
                 for tag in device['tags']:
@@ -278,16 +555,231 @@ for csv_device in csv_list_dict:
                 updated_device['server_group_id'] = device['server_group_id']
                 tags_new.append(csv_device['owner_tag'])
                 updated_device['tags'] = tags_new
-                devices_to_update.append(updated_device)
-    if not found:
-        print("Warning - device from CSV " + csv_device['display_name'] + " not found in Automox!  Skipping device.")
+                # Kept so the update can be re-planned from the device's current tags before it is sent
+                updated_device['owner_tag'] = csv_device['owner_tag']
+                updated_device['tag_header'] = tag_header
+                updated_devices.append(updated_device)
+        row_plans.append((row_position, match_type is not None, [device['id'] for device in matched_devices], messages, updated_devices))
+    return row_plans
+
+# Pick the shard for a hostname - hashed on the normalized name so exact and normalized matches land in the same shard
+def ax_hostname_shard(hostname, shard_count):
+    return zlib.crc32(ax_hostname_normalize(hostname).encode('utf-8')) % shard_count
+
+# Plan the tag changes across a process pool, sharding CSV rows and devices by hashed hostname
+def ax_tag_plan_sharded(csv_rows, device_list, tag_header, fuzzy_match_threshold, fuzzy_match_apply, processes):
+    shard_rows = [[] for shard in range(processes)]
+    shard_devices = [[] for shard in range(processes)]
+    for row_position, csv_device in csv_rows:
+        shard_rows[ax_hostname_shard(csv_device['display_name'], processes)].append((row_position, csv_device))
+    for device in device_list:
+        # Only send the fields planning needs to the workers
+        planning_device = {'id': device['id'], 'display_name': device['display_name'], 'server_group_id': device['server_group_id'], 'tags': device['tags']}
+        shard_devices[ax_hostname_shard(device['display_name'], processes)].append(planning_device)
+
+    # Shards only see their own devices, so fuzzy matching waits for the merge
+    row_plans = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        for shard_plan in executor.map(ax_tag_plan, shard_rows, shard_devices, [tag_header] * processes, [None] * processes):
+            row_plans.extend(shard_plan)
+
+    if fuzzy_match_threshold is not None:
+        csv_rows_by_position = dict(csv_rows)
+        unfound_rows = [(row_plan[0], csv_rows_by_position[row_plan[0]]) for row_plan in row_plans if not row_plan[1]]
+        if unfound_rows:
+            fuzzy_row_plans = ax_tag_plan(unfound_rows, device_list, tag_header, fuzzy_match_threshold, fuzzy_match_apply)
+            row_plans = [row_plan for row_plan in row_plans if row_plan[1]] + fuzzy_row_plans
+
+    row_plans.sort(key=lambda row_plan: row_plan[0])
+    return row_plans
+
+# --Execution Block-- #
+# Guarded so the planning worker processes can import this script without running it
+if __name__ == '__main__':
+    # --Parse command line arguments-- #
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        'ax_org_id',
+        type=str,
+        help='Automox Org ID.')
+
+    parser.add_argument(
+        'ax_api_key',
+        type=str,
+        help='Automox API Key.')
+
+    parser.add_argument(
+        'csv_file',
+        type=str,
+        help='File name (and path, if needed) for the CSV file to sync groups for.')
+
+    parser.add_argument(
+        '-csv_column_hostname_position',
+        type=int,
+        default=0,
+        help='(Optional - Default to 0)  Column positon in CSV that contains the hostname to compare.')
+
+    parser.add_argument(
+        '-csv_column_owner_position',
+        type=int,
+        default=1,
+        help='(Optional - Default to 1)  Column positon in CSV that contains the owner information.')
+
+    parser.add_argument(
+        '-tag_header',
+        type=str,
+        default='Owner-',
+        help='(Optional - Default to "Owner-")  Header for the added tag.')
+
+    parser.add_argument(
+        '-fuzzy_match_threshold',
+        type=float,
+        help='(Optional) Fall back to trigram similarity for CSV names with no exact or normalized (case, whitespace, domain) match.  Minimum similarity 0-1, ex. 0.8')
+
+    parser.add_argument(
+        '-fuzzy_match_apply',
+        action='store_true',
+        help='(Optional-Flag) Apply fuzzy matches found with -fuzzy_match_threshold.  Without it they are only printed as suggestions.')
+
+    parser.add_argument(
+        '-snapshot',
+        type=str,
+        help='(Optional) Load the device list from a snapshot file (written by ax-device-list-with-query.py -snapshot_save) instead of calling the API.  Each planned device is fetched again and re-planned before it is updated.')
+
+    parser.add_argument(
+        '-snapshot_max_age',
+        type=int,
+        default=15,
+        help='(Optional - Default to 15)  Refuse a -snapshot saved more than this many minutes ago, since this run changes devices based on it.')
+
+    parser.add_argument(
+        '-max_workers',
+        type=int,
+        default=8,
+        help='(Optional - Default to 8)  Most update calls to run at once.  Concurrency starts low and adapts to API latency and throttling (1 = one at a time).')
+
+    parser.add_argument(
+        '-planning_processes',
+        type=int,
+        default=1,
+        help='(Optional - Default to 1)  Processes to plan tag changes with.  CSV rows and devices are sharded by hostname across them, for very large CSVs.')
+
+    parser.add_argument(
+        '-http2',
+        action='store_true',
+        help='(Optional-Flag) Send the API calls over HTTP/2 (needs httpx: pip install httpx[http2]).  Concurrent bulk writes then share one multiplexed connection instead of one connection per worker.  Compare the two with ax-bulk-http2-benchmark.py.')
+
+    parser.add_argument(
+        '-profile',
+        type=str,
+        help='(Optional) Profile the run with cProfile and write the stats to this file (phase timing summary goes to <file>.txt).  Bulk writes run on worker threads that cProfile does not follow, so the apply phase shows in the phase timing (wall time) but not in the function stats.')
+
+    args = parser.parse_args()
+    # --End parse command line arguments-- #
+
+    # --Main-- #
+
+    # Create environment dict & vars
+    ax_environment = {}
+    ax_environment['automox-org-id'] = args.ax_org_id
+    ax_environment['automox-api-key'] = args.ax_api_key
+
+    if args.profile:
+        ax_profile_start(args.profile)
+    if args.http2:
+        ax_session_http2()
+    csv_column_hostname_position = args.csv_column_hostname_position
+    csv_column_owner_position = args.csv_column_owner_position
+    csv_file = args.csv_file
+    tag_header = args.tag_header
+    fuzzy_match_threshold = args.fuzzy_match_threshold
 
-if len(devices_to_update) > 0:
-    print("Updating devices using the API...")
     print()
-    for updated_device in devices_to_update:
-        print("Updating device " + updated_device['display_name'])
-        response = ax_device_put(ax_environment, updated_device['id'], tags=updated_device['tags'], server_group_id=updated_device['server_group_id'])
-    print("Done!")
-else:
-    print("Did not find anything to do!")
+    ax_profile_phase('load')
+    print("Loading the CSV...")
+    csv_list = ax_file_load_csv_list(csv_file)
+
+    ax_profile_phase('plan')
+    print("Checking for any rows with extra or not enough data...")
+    row_count = 0
+    csv_list_new = []
+    for row in csv_list:
+        row_count = row_count + 1
+        if len(row) != 0:
+            if len(row) != 2:
+                if len(row) > 2:
+                    print("Found a row with more than 2 data objects - skipping row:")
+                    print("Row #: " + str(row_count))
+                    print("Row data: ")
+                    print(row)
+                    print()
+                else:
+                    print("Found a row with less than 2 data objects - skipping row:")
+                    print("Row #: " + str(row_count))
+                    print("Row data: ")
+                    print(row)
+                    print()
+            else:
+                csv_list_new.append(row)
+    if len(csv_list_new) == 0:
+        ax_exit_error(400, "No valid rows found in the CSV.  Exiting!")
+    else:
+        csv_list = csv_list_new
+
+    # Converting the import into a dict format to make things easier to find and expand on in the future
+    csv_list_dict = []
+    duplicate_names_test_list = []
+    for row in csv_list:
+        row_dict = {}
+        row_dict['display_name'] = row[csv_column_hostname_position]
+        row_dict['owner'] = row[csv_column_owner_position]
+        row_dict['owner_tag'] = tag_header + row_dict['owner']
+        # Create a lower case version of the hostname for later tests
+        row_dict['display_name_lower'] = row_dict['display_name'].lower()
+        # Add hostname to a list for testing for duplicates
+        duplicate_names_test_list.append(row_dict['display_name_lower'])
+        # Add the new dict to the new list for import
+        csv_list_dict.append(row_dict)
+
+    print("Checking for any duplicate host names from the CSV import list...")
+    duplicate_found = duplicate_check(duplicate_names_test_list)
+    if duplicate_found:
+        print("Found duplicate host name in the CSV import list:" + str(duplicate_found))
+        ax_exit_error(400)
+
+    ax_profile_phase('fetch')
+    if args.snapshot:
+        print("Loading the device list from snapshot " + args.snapshot + "...")
+        device_list = ax_snapshot_device_list(args.snapshot, ['id', 'display_name', 'server_group_id', 'tags'], args.snapshot_max_age)
+    else:
+        print("Calling the API to get the device list...")
+        device_list = ax_device_list_get(ax_environment)
+
+    ax_profile_phase('plan')
+    print("Matching device changes based on CSV values...")
+    csv_rows = list(enumerate(csv_list_dict))
+    if args.planning_processes > 1:
+        row_plans = ax_tag_plan_sharded(csv_rows, device_list, tag_header, fuzzy_match_threshold, args.fuzzy_match_apply, args.planning_processes)
+    else:
+        row_plans = ax_tag_plan(csv_rows, device_list, tag_header, fuzzy_match_threshold, args.fuzzy_match_apply)
+
+    # Rows that resolve to the same device (ex. host01 and host01.corp.com) would overwrite each other's tag
+    row_conflicts = ax_hostname_row_conflicts([csv_list_dict[row_plan[0]]['display_name'] for row_plan in row_plans], [row_plan[2] for row_plan in row_plans])
+    devices_to_update = []
+    for row_position, found, matched_device_ids, messages, updated_devices in row_plans:
+        for message in messages:
+            print(message)
+        if row_position in row_conflicts:
+            print("Warning - device from CSV " + csv_list_dict[row_position]['display_name'] + " matches the same device as " + ", ".join(row_conflicts[row_position]) + "!  Skipping device.")
+            continue
+        devices_to_update.extend(updated_devices)
+
+    if len(devices_to_update) > 0:
+        ax_profile_phase('apply')
+        print("Updating devices using the API...")
+        print()
+        ax_bulk_apply(devices_to_update, functools.partial(ax_device_update_apply, ax_environment, bool(args.snapshot)), args.max_workers)
+        print("Done!")
+    else:
+        print("Did not find anything to do!")